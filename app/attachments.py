@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+
+from storage import JsonIndex
+
+
+class AttachmentStore:
+    """
+    Content-addressed store for downloaded attachments.
+
+    Files live under <root>/<sha256>/<filename>, so identical files fetched
+    from different urls are stored once. index.json maps each url to the
+    validators the server sent (ETag, Last-Modified) together with the size
+    and sha256 of the stored file, which lets a re-fetch be a conditional
+    request that transfers no body when the file has not changed.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._index = JsonIndex(self.root / 'index.json')
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(AttachmentStore.__name__)
+
+    def partial_path(self, url: str) -> Path:
+        partial_dir = self.root / '.partial'
+        partial_dir.mkdir(exist_ok=True)
+        return partial_dir / f"{hashlib.sha1(url.encode()).hexdigest()}.part"
+
+    def partial_validator(self, url: str) -> str:
+        """Return the If-Range validator of the partial download of url, or ''."""
+        validator_path = self.partial_path(url).with_suffix('.validator')
+        return validator_path.read_text() if validator_path.exists() else ''
+
+    def start_partial(self, url: str, headers) -> None:
+        """Remember the validator of a download of url that starts from scratch."""
+        validator_path = self.partial_path(url).with_suffix('.validator')
+        # If-Range only accepts a strong ETag, Last-Modified is the fallback
+        etag = headers.get('etag', '')
+        validator = etag if etag and not etag.startswith('W/') else headers.get('last-modified', '')
+        if validator:
+            validator_path.write_text(validator)
+        else:
+            validator_path.unlink(missing_ok=True)
+
+    def discard_partial(self, url: str) -> None:
+        part_path = self.partial_path(url)
+        part_path.unlink(missing_ok=True)
+        part_path.with_suffix('.validator').unlink(missing_ok=True)
+
+    def lookup(self, url: str):
+        """Return the index entry for url if its file is still on disk."""
+        entry = self._index.get(url)
+        if entry and (self.root / entry['path']).exists():
+            return entry
+        return None
+
+    def path_of(self, entry: dict) -> Path:
+        return self.root / entry['path']
+
+    def conditional_headers(self, entry: dict) -> dict:
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def add(self, url: str, tmp_path: Path, fname: str, headers) -> Path:
+        """
+        Move a completed download into the store and index it under url.
+
+        If a file with the same content is already stored, tmp_path is
+        discarded and the existing copy is returned.
+        """
+        sha256 = hashlib.sha256()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        size = os.path.getsize(tmp_path)
+        tmp_path.with_suffix('.validator').unlink(missing_ok=True)
+
+        with self._lock:
+            blob_dir = self.root / digest
+            existing = next(blob_dir.iterdir(), None) if blob_dir.exists() else None
+            if existing:
+                self._logger.info(f"{fname} is identical to {existing}, reusing it")
+                tmp_path.unlink()
+                full_path = existing
+            else:
+                blob_dir.mkdir(exist_ok=True)
+                full_path = blob_dir / fname
+                tmp_path.replace(full_path)
+
+            self._index.set(url, {
+                'path': str(full_path.relative_to(self.root)),
+                'etag': headers.get('etag', ''),
+                'last_modified': headers.get('last-modified', ''),
+                'size': size,
+                'sha256': digest,
+            })
+
+        return full_path
@@ -0,0 +1,234 @@
+"""
+Course feed parsers.
+
+Two interchangeable backends extract the same fields from the feed html:
+
+- "lxml": walks each post element once with lxml, the fast path, and can
+  parse a feed incrementally as it streams in
+- "html.parser": BeautifulSoup with the standard library parser, used when
+  lxml is not installed
+
+Both keep the raw html of the content and attachments instead of
+prettifying it.
+"""
+import logging
+import os
+from html import escape
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:  # pragma: no cover - lxml is optional
+    lxml = None
+
+
+def _class_matches(value, wanted):
+    # Same rule BeautifulSoup uses: match a single class or the whole attribute
+    classes = (value or '').split()
+    return wanted in classes or ' '.join(classes) == wanted
+
+
+def _is_post(class_value):
+    # Posts are the <li> elements with a "first" or an empty class attribute
+    return class_value is not None and (_class_matches(class_value, 'first')
+                                        or not class_value.strip())
+
+
+def _new_post(post_id):
+    return {
+        'post_id': post_id,
+        'datetime': '',
+        'author': '',
+        'profile_pic_url': '',
+        'content': '',
+        'html_content': '',
+        'attachments_html_content': '',
+        'show_more_href': '',
+        'images': [],
+        'attachments': [],
+    }
+
+
+class SoupFeedParser:
+    name = 'html.parser'
+
+    def iter_posts(self, html):
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(html, 'html.parser')
+        for post in soup.find_all('li', {'class': ['first', '']}):
+            yield self._parse_post(post)
+
+    def _parse_post(self, post):
+        parsed = _new_post(post.get('id', '').replace('edge-assoc-', ''))
+
+        post_datetime = post.find('span', {'class': 'small gray'})
+        parsed['datetime'] = post_datetime.text if post_datetime else ''
+
+        author = post.find('a', {'title': 'View user profile.'})
+        parsed['author'] = author.text if author else ''
+
+        profile_pic = post.find(
+            'img', {'class': 'imagecache imagecache-profile_sm'})
+        parsed['profile_pic_url'] = profile_pic.get('src', '') if profile_pic else ''
+
+        content_span = post.find('span', {'class': 'update-body s-rte'})
+        if content_span:
+            parsed['html_content'] = str(content_span)
+            parsed['content'] = content_span.get_text()
+            parsed['images'] = [img.get('src', '')
+                                for img in content_span.find_all('img')]
+
+        show_more_link = post.find('a', {'class': 'show-more-link'})
+        parsed['show_more_href'] = show_more_link.get(
+            'href', '') if show_more_link else ''
+
+        attachments_div = post.find('div', {'class': 'attachments clearfix'})
+        if attachments_div:
+            parsed['attachments_html_content'] = str(attachments_div)
+            for a in attachments_div.find_all('a'):
+                span = a.find('span')
+                if span:
+                    parsed['attachments'].append({
+                        'href': a.get('href'),
+                        'filename': span.get('aria-label'),
+                    })
+
+        return parsed
+
+    def parse_fragment(self, html):
+        """Return the raw html, text and image urls of a show-more payload."""
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(html, 'html.parser')
+        images = [img.get('src', '') for img in soup.find_all('img')]
+        return str(soup), soup.get_text(), images
+
+    def iter_posts_stream(self, chunks):
+        # html.parser has no incremental tree builder, so the feed is
+        # buffered and parsed as a whole
+        return self.iter_posts(''.join(chunks))
+
+
+class LxmlFeedParser:
+    name = 'lxml'
+
+    def iter_posts(self, html):
+        root = lxml.html.document_fromstring(html)
+        for post in root.iter('li'):
+            if _is_post(post.get('class')):
+                yield self.parse_post_element(post)
+
+    def iter_posts_stream(self, chunks):
+        """
+        Yield the posts of a feed given as text chunks as soon as each is complete.
+
+        Posts are removed from the tree once parsed, so memory use does not
+        grow with the length of the feed.
+        """
+        parser = etree.HTMLPullParser(events=('end',), tag='li')
+        parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+        for chunk in chunks:
+            parser.feed(chunk)
+            yield from self._read_posts(parser)
+        parser.close()
+        yield from self._read_posts(parser)
+
+    def _read_posts(self, parser):
+        for _, element in parser.read_events():
+            if not _is_post(element.get('class')):
+                continue
+            yield self.parse_post_element(element)
+            parent = element.getparent()
+            # A post nested in another <li> is still needed for its parent
+            if parent is not None and parent.tag != 'li':
+                element.clear(keep_tail=True)
+                while element.getprevious() is not None:
+                    del parent[0]
+
+    @staticmethod
+    def _to_html(element):
+        return etree.tostring(element, encoding='unicode', method='html',
+                              with_tail=False)
+
+    def parse_post_element(self, post):
+        parsed = _new_post(post.get('id', '').replace('edge-assoc-', ''))
+        matched = {'datetime': None, 'author': None, 'profile_pic': None,
+                   'content': None, 'show_more': None, 'attachments': None}
+
+        # One pass over the post, keeping the first match of every field
+        for el in post.iter(tag=etree.Element):
+            tag = el.tag
+            class_value = el.get('class')
+            if tag == 'span':
+                if matched['datetime'] is None and _class_matches(class_value, 'small gray'):
+                    matched['datetime'] = el
+                elif matched['content'] is None and _class_matches(class_value, 'update-body s-rte'):
+                    matched['content'] = el
+            elif tag == 'a':
+                if matched['author'] is None and el.get('title') == 'View user profile.':
+                    matched['author'] = el
+                elif matched['show_more'] is None and _class_matches(class_value, 'show-more-link'):
+                    matched['show_more'] = el
+            elif tag == 'img':
+                if matched['profile_pic'] is None and _class_matches(class_value, 'imagecache imagecache-profile_sm'):
+                    matched['profile_pic'] = el
+            elif tag == 'div':
+                if matched['attachments'] is None and _class_matches(class_value, 'attachments clearfix'):
+                    matched['attachments'] = el
+
+        if matched['datetime'] is not None:
+            parsed['datetime'] = matched['datetime'].text_content()
+        if matched['author'] is not None:
+            parsed['author'] = matched['author'].text_content()
+        if matched['profile_pic'] is not None:
+            parsed['profile_pic_url'] = matched['profile_pic'].get('src', '')
+        if matched['show_more'] is not None:
+            parsed['show_more_href'] = matched['show_more'].get('href', '')
+
+        content_span = matched['content']
+        attachments_div = matched['attachments']
+        if content_span is not None:
+            parsed['html_content'] = self._to_html(content_span)
+            parsed['content'] = content_span.text_content()
+            parsed['images'] = [img.get('src', '') for img in content_span.iter('img')]
+
+        if attachments_div is not None:
+            parsed['attachments_html_content'] = self._to_html(attachments_div)
+            for a in attachments_div.iter('a'):
+                span = next(a.iter('span'), None)
+                if span is not None:
+                    parsed['attachments'].append({
+                        'href': a.get('href'),
+                        'filename': span.get('aria-label'),
+                    })
+
+        return parsed
+
+    def parse_fragment(self, html):
+        """Return the raw html, text and image urls of a show-more payload."""
+        fragment = lxml.html.fragment_fromstring(html, create_parent='div')
+        images = [img.get('src', '') for img in fragment.iter('img')]
+        raw_html = escape(fragment.text or '') + ''.join(
+            etree.tostring(child, encoding='unicode', method='html')
+            for child in fragment)
+        return raw_html, fragment.text_content(), images
+
+
+BACKENDS = {
+    SoupFeedParser.name: SoupFeedParser,
+    LxmlFeedParser.name: LxmlFeedParser,
+}
+
+
+def get_feed_parser(backend=None):
+    """
+    Return a feed parser for the given backend name.
+
+    Defaults to FEED_PARSER_BACKEND, or lxml when it is installed.
+    """
+    backend = backend or os.environ.get("FEED_PARSER_BACKEND", LxmlFeedParser.name)
+    if backend == LxmlFeedParser.name and lxml is None:
+        logging.warning("lxml is not installed, falling back to html.parser")
+        backend = SoupFeedParser.name
+    return BACKENDS[backend]()
@@ -0,0 +1,72 @@
+import hashlib
+import io
+from pathlib import Path
+
+from storage import JsonIndex, atomic_write
+
+# Formats that are re-encoded after downscaling, anything else (e.g.
+# animated GIFs) is stored as received
+DOWNSCALE_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+
+def downscale_image(data: bytes, max_dimension: int):
+    """
+    Downscale an image to at most max_dimension pixels on either side.
+
+    Returns the image data and its file extension. Decoding a photo takes
+    tens of megabytes, so this is meant to run in a worker process, where
+    that memory does not pile up in the allocator arenas of the threads of
+    the main process.
+
+    Raises:
+    - ValueError if data is not an image.
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            ext = DOWNSCALE_FORMATS.get(image.format)
+            if ext is None or max(image.size) <= max_dimension:
+                return data, ext or (image.format or 'bin').lower()
+            image_format = image.format
+            image.thumbnail((max_dimension, max_dimension))
+            buffer = io.BytesIO()
+            if image_format == 'JPEG':
+                image.save(buffer, image_format, quality=85, optimize=True)
+            else:
+                image.save(buffer, image_format)
+            return buffer.getvalue(), ext
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError(f"Not a readable image: {e}") from e
+
+
+class ImageStore:
+    """
+    Downscaled copies of post images, kept across runs.
+
+    Images are stored as <root>/<sha256>.<ext> of their downscaled content,
+    so identical images behind different urls are stored once. index.json
+    maps each url to its file; Schoology image urls never change content,
+    so an indexed url is never fetched again.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._index = JsonIndex(self.root / 'index.json')
+
+    def lookup(self, url: str):
+        """Return the stored image of url, or None."""
+        name = self._index.get(url)
+        if name and (self.root / name).exists():
+            return self.root / name
+        return None
+
+    def add(self, url: str, data: bytes, ext: str) -> Path:
+        """Store the downscaled image data fetched from url and index it."""
+        name = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+        path = self.root / name
+        if not path.exists():
+            atomic_write(path, data)
+        self._index.set(url, name)
+        return path
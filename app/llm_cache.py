@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from storage import atomic_write
+
+
+class LLMCache:
+    """
+    On-disk cache of LLM responses.
+
+    Each response is stored as <dir>/<key>.json where the key is a sha256 of
+    the prompt template, model name and prompt inputs. Entries older than
+    max_age_days are dropped, and once the cache grows past max_bytes the
+    least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int, max_age_days: float) -> None:
+        self._dir = cache_dir
+        self._max_bytes = max_bytes
+        self._max_age = max_age_days * 24 * 3600
+        self._lock = threading.Lock()
+        self._size = None
+        self._logger = logging.getLogger(LLMCache.__name__)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(template: str, model: str, inputs: dict) -> str:
+        payload = json.dumps([template, model, inputs], sort_keys=True,
+                             ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str):
+        path = self._dir / f"{key}.json"
+        try:
+            age = time.time() - path.stat().st_mtime
+            if age > self._max_age:
+                raise FileNotFoundError
+            with open(path, 'r') as f:
+                response = json.load(f)['response']
+        except (FileNotFoundError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        # Touch the entry so eviction keeps recently used responses
+        path.touch()
+        with self._lock:
+            self.hits += 1
+        return response
+
+    def put(self, key: str, response: str) -> None:
+        self._dir.mkdir(parents=True, exist_ok=True)
+        path = self._dir / f"{key}.json"
+        atomic_write(path, json.dumps({'response': response, 'created': time.time()},
+                                      ensure_ascii=False))
+        with self._lock:
+            if self._size is None:
+                self._size = sum(p.stat().st_size for p in self._dir.glob('*.json'))
+            else:
+                self._size += path.stat().st_size
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted(self._dir.glob('*.json'), key=lambda p: p.stat().st_mtime)
+        now = time.time()
+        size = sum(p.stat().st_size for p in entries)
+        for path in entries:
+            if size <= self._max_bytes * 0.9 and now - path.stat().st_mtime <= self._max_age:
+                break
+            size -= path.stat().st_size
+            path.unlink(missing_ok=True)
+        self._size = size
+        self._logger.info(f"Evicted LLM cache entries, {size} bytes left")
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,265 @@
+import base64
+import logging
+import mimetypes
+import os
+import smtplib
+import socket
+import uuid
+from email.header import Header
+from email.utils import encode_rfc2231, formatdate, make_msgid
+
+from metrics import metrics
+
+CRLF = b'\r\n'
+# 57 input bytes encode to one 76 character base64 line
+BASE64_LINE_BYTES = 57
+BASE64_CHUNK_BYTES = BASE64_LINE_BYTES * 1024
+SEND_BUFFER_BYTES = 64 * 1024
+
+
+class EmailDeliveryError(Exception):
+    pass
+
+
+class EmailMaybeDeliveredError(EmailDeliveryError):
+    """The connection was lost after the whole message was sent, so it may have been delivered."""
+
+
+def _base64_lines(chunks):
+    """Encode an iterable of byte chunks as CRLF terminated base64 lines."""
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        cut = len(pending) - len(pending) % BASE64_LINE_BYTES
+        for i in range(0, cut, BASE64_LINE_BYTES):
+            yield base64.b64encode(pending[i:i + BASE64_LINE_BYTES]) + CRLF
+        pending = pending[cut:]
+    if pending:
+        yield base64.b64encode(pending) + CRLF
+
+
+def _file_chunks(file_path):
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BASE64_CHUNK_BYTES), b''):
+            yield chunk
+
+
+def _header(name, value):
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        # Long values are folded, with CRLF as the message is sent as is
+        value = Header(value, 'utf-8').encode(linesep='\r\n')
+    return f"{name}: {value}".encode('ascii') + CRLF
+
+
+def _html_part(html_content):
+    yield _header('Content-Type', 'text/html; charset="utf-8"')
+    yield _header('Content-Transfer-Encoding', 'base64')
+    yield CRLF
+    yield from _base64_lines([html_content.encode('utf-8')])
+
+
+def iter_message_lines(sender_email, receiver_email, subject, html_content,
+                       attachment_file_paths, inline_images=None):
+    """
+    Yield a multipart/mixed message line by line.
+
+    Attachments are read and base64 encoded in chunks, so memory use does
+    not depend on attachment size. BCC recipients are not listed in the
+    headers; they are only passed as envelope recipients. inline_images is
+    a list of (content id, path) of images the html refers to as cid:<id>;
+    they are sent with the html in a multipart/related part.
+    """
+    boundary = f"=={uuid.uuid4().hex}=="
+    yield _header('From', sender_email)
+    yield _header('To', receiver_email)
+    yield _header('Subject', subject)
+    yield _header('Date', formatdate(localtime=True))
+    yield _header('Message-ID', make_msgid())
+    yield _header('MIME-Version', '1.0')
+    yield _header('Content-Type', f'multipart/mixed; boundary="{boundary}"')
+    yield CRLF
+
+    yield f"--{boundary}".encode() + CRLF
+    if inline_images:
+        related_boundary = f"=={uuid.uuid4().hex}=="
+        yield _header('Content-Type', f'multipart/related; boundary="{related_boundary}"')
+        yield CRLF
+        yield f"--{related_boundary}".encode() + CRLF
+        yield from _html_part(html_content)
+        for content_id, file_path in inline_images:
+            filename = encode_rfc2231(os.path.basename(file_path), 'utf-8')
+            yield f"--{related_boundary}".encode() + CRLF
+            yield _header('Content-Type',
+                          mimetypes.guess_type(str(file_path))[0] or 'application/octet-stream')
+            yield _header('Content-Transfer-Encoding', 'base64')
+            yield _header('Content-ID', f"<{content_id}>")
+            yield _header('Content-Disposition', f"inline; filename*={filename}")
+            yield CRLF
+            yield from _base64_lines(_file_chunks(file_path))
+        yield f"--{related_boundary}--".encode() + CRLF
+    else:
+        yield from _html_part(html_content)
+
+    for file_path in attachment_file_paths:
+        filename = encode_rfc2231(os.path.basename(file_path), 'utf-8')
+        yield f"--{boundary}".encode() + CRLF
+        yield _header('Content-Type', 'application/octet-stream')
+        yield _header('Content-Transfer-Encoding', 'base64')
+        yield _header('Content-Disposition', f"attachment; filename*={filename}")
+        yield CRLF
+        yield from _base64_lines(_file_chunks(file_path))
+
+    yield f"--{boundary}--".encode() + CRLF
+
+
+class MailTransport:
+    """
+    SMTP connection shared by all emails of a run.
+
+    The connection is opened on the first send and reused afterwards. If
+    the server drops it, the transport reconnects and retries the message
+    once. Use it as a context manager so the connection is closed at the
+    end of the run.
+    """
+
+    def __init__(self, host=None, port=None, use_ssl=None, username=None,
+                 password=None, timeout=60):
+        self._host = host or os.environ.get("SMTP_HOST", "smtp.gmail.com")
+        self._port = int(port or os.environ.get("SMTP_PORT", 465))
+        self._use_ssl = use_ssl if use_ssl is not None else \
+            os.environ.get("SMTP_SSL", "1") == "1"
+        self._username = username or os.environ.get("SMTP_USERNAME")
+        self._password = password or os.getenv('GOOGLE_APP_PASSWORD')
+        self._timeout = timeout
+        self._server = None
+        self._logger = logging.getLogger(MailTransport.__name__)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connect(self, login_user):
+        if self._use_ssl and not self._password:
+            raise ValueError("App password not found in environment variables.")
+        self._logger.info(f"Connecting to SMTP server {self._host}:{self._port} ...")
+        metrics.incr('smtp_connections')
+        if self._use_ssl:
+            server = smtplib.SMTP_SSL(self._host, self._port, timeout=self._timeout)
+        else:
+            server = smtplib.SMTP(self._host, self._port, timeout=self._timeout)
+        # Commands are small writes waiting on replies, don't let Nagle delay them
+        server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # MAIL is sent by hand, so greet the server even without a login
+        server.ehlo_or_helo_if_needed()
+        if self._password:
+            server.login(self._username or login_user, self._password)
+        self._server = server
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+    def _send_lines(self, sender, recipients, lines):
+        server = self._server
+        code, resp = server.mail(sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, sender)
+        # Like sendmail(), deliver to the accepted recipients and only fail
+        # when every recipient was refused
+        refused = {}
+        for recipient in recipients:
+            code, resp = server.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, resp)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        for recipient, (code, resp) in refused.items():
+            self._logger.warning(f"Recipient {recipient} refused: {code} {resp!r}")
+            metrics.incr('smtp_recipients_refused')
+        code, resp = server.docmd('DATA')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        # Lines are batched into larger writes, base64 lines are tiny
+        buffer = []
+        buffered = 0
+        sent = 0
+        try:
+            for line in lines:
+                # Dot-stuffing, see RFC 5321 section 4.5.2
+                if line.startswith(b'.'):
+                    line = b'.' + line
+                buffer.append(line)
+                buffered += len(line)
+                if buffered >= SEND_BUFFER_BYTES:
+                    server.send(b''.join(buffer))
+                    sent += buffered
+                    buffer = []
+                    buffered = 0
+            if buffer:
+                server.send(b''.join(buffer))
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            raise
+        except Exception as e:
+            # E.g. an attachment that cannot be read. The message was never
+            # terminated, so it is not delivered, but the connection is
+            # stuck in DATA and cannot be reset
+            server.close()
+            self._server = None
+            raise EmailDeliveryError(f"Failed to build the message: {e}") from e
+        metrics.incr('smtp_bytes', sent + buffered)
+        server.putcmd('.')
+        try:
+            code, resp = server.getreply()
+        except (smtplib.SMTPServerDisconnected, OSError) as e:
+            # Sending it again could deliver the message twice
+            raise EmailMaybeDeliveredError(
+                f"SMTP connection lost after sending the message: {e}") from e
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def send(self, sender, recipients, build_lines):
+        """
+        Send one message.
+
+        build_lines is called to produce the message lines, once per attempt.
+        Raises EmailDeliveryError if the message could not be delivered, for
+        any reason including a missing password, or EmailMaybeDeliveredError
+        without retrying if the connection was lost while waiting for the
+        server to accept the sent message.
+        """
+        for attempt in range(2):
+            try:
+                if self._server is None:
+                    self._connect(sender)
+                self._send_lines(sender, recipients, build_lines())
+                return
+            except EmailMaybeDeliveredError:
+                self.close()
+                raise
+            except EmailDeliveryError:
+                raise
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self._server = None
+                if attempt:
+                    raise EmailDeliveryError(f"SMTP connection lost: {e}") from e
+                self._logger.info(f"SMTP connection lost ({e}), reconnecting ...")
+            except (smtplib.SMTPException, OSError) as e:
+                # Reset the transaction so the connection can be reused
+                try:
+                    self._server.rset()
+                except (smtplib.SMTPException, OSError, AttributeError):
+                    self.close()
+                raise EmailDeliveryError(str(e)) from e
+            except Exception as e:
+                # Callers journal the message as being sent, so anything that
+                # fails before it was sent has to say it was not delivered
+                self.close()
+                raise EmailDeliveryError(str(e)) from e
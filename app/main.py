@@ -1,24 +1,36 @@
+import codecs
+import hashlib
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import pickle
-import random
 import re
 import shutil
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime
+from html import escape, unescape
 from pathlib import Path
-from string import ascii_lowercase, digits
+from urllib.parse import urljoin, urlparse
 
 import requests
-from bs4 import BeautifulSoup
 from dotenv import find_dotenv, load_dotenv
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from utils import send_email, summarize, translate, extract_text_from_pdf, markdown_to_html
+# selenium is imported by the login methods that drive Chrome
+from attachments import AttachmentStore
+from feed_parser import get_feed_parser
+from images import ImageStore, downscale_image
+from mail import EmailDeliveryError, EmailMaybeDeliveredError, MailTransport
+from metrics import metrics
+from state import (STAGES, STATUS_DONE, STATUS_DOWNLOADED, STATUS_EMAILING,
+                   STATUS_PARSED, STATUS_SUMMARIZED, STATUS_TRANSLATED, StateStore)
+from transport import create_session
+from watch import PollSchedule
+from utils import send_email, summarize, summarize_digest, summarize_multilingual, translate, extract_text_from_pdf, markdown_to_html, llm_cache, remove_repeated_lines, estimate_tokens, PAGE_BREAK, SUMMARY_MAX_TOKENS, SUMMARY_MODE
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s",
                     level=logging.INFO)
@@ -27,308 +39,833 @@ logging.basicConfig(format="%(asctime)s - %(levelname)s: %(message)s",
 load_dotenv(find_dotenv(usecwd=True))
 
 
+# The feed is read in chunks of this size
+FEED_CHUNK_BYTES = 64 * 1024
+# Number of newest post ids the feed fingerprint is made of. New posts are
+# added at the top, so they always change it.
+FINGERPRINT_POST_IDS = 20
+POST_ID_MARKER = b'edge-assoc-'
+POST_ID_PATTERN = re.compile(re.escape(POST_ID_MARKER) + rb'(\d+)')
+
+
+class SessionExpiredError(Exception):
+    pass
+
+
+def _iter_feed_html(chunks):
+    """
+    Decode the chunks of a feed response into html text.
+
+    The feed html comes wrapped in JSON with escaped characters and
+    slashes. Chunks are unescaped incrementally, holding back a trailing
+    backslash whose escaped slash may continue in the next chunk.
+    """
+    decoder = codecs.getincrementaldecoder('unicode_escape')()
+    pending = ''
+    for chunk in chunks:
+        metrics.incr('feed_bytes', len(chunk))
+        text = pending + decoder.decode(chunk)
+        pending = ''
+        if text.endswith('\\'):
+            text, pending = text[:-1], '\\'
+        yield text.replace('\\/', '/')
+    yield (pending + decoder.decode(b'', final=True)).replace('\\/', '/')
+
+
+def _read_post_ids(chunks, count):
+    """
+    Read chunks of the feed until the first count post ids are known.
+
+    Returns the chunks read and the post ids. Every chunk is only scanned
+    together with the few bytes before it that may hold the start of an
+    id, and an id running up to the end of a chunk is only taken once the
+    next chunk shows where it ends.
+    """
+    head = []
+    post_ids = []
+    pending = b''
+    for chunk in chunks:
+        head.append(chunk)
+        text = pending + chunk
+        # Bytes that may be the start of the next id, up to a whole marker
+        # whose digits are still to come
+        pending_start = len(text) - len(POST_ID_MARKER)
+        for match in re.finditer(POST_ID_PATTERN, text):
+            if match.end() == len(text):
+                pending_start = match.start()
+                break
+            post_ids.append(match.group(1))
+        pending = text[max(pending_start, 0):]
+        if len(post_ids) >= count:
+            return head, post_ids[:count]
+    # The last id of the feed ends with the response
+    post_ids.extend(re.findall(POST_ID_PATTERN, pending))
+    return head, post_ids[:count]
+
+
 class SchoologyAlbumsDownloader:
 
     def __init__(self,
                  timeout: int = 30,
                  headless: bool = True,
-                 subdomain: str = "") -> None:
+                 subdomain: str = "",
+                 base_url: str = "") -> None:
         self._timeout = timeout
-        self._base_url = f"https://{subdomain}.schoology.com"
+        self._base_url = base_url or f"https://{subdomain}.schoology.com"
         self.subdomain = subdomain
         self._logger = logging.getLogger(
             SchoologyAlbumsDownloader.__class__.__name__)
-        options = Options()
-        options.add_argument("--no-sandbox")
-        options.add_argument('--disable-dev-shm-usage')
-        options.add_argument('--disable-search-engine-choice-screen')
-        options.add_argument('--disable-gpu')
-        if headless:
-            options.add_argument("--headless=new")
-        self.driver = webdriver.Chrome(options=options)
+        self._headless = headless
+        self._driver = None
         headers = {
             "User-Agent":
             "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36"
         }
-        self.session = requests.session()
-        self.session.headers.update(headers)
-        self._config_file = Path('.sadc.conf')
-        self._load_config()
+        self._download_workers = int(os.environ.get("DOWNLOAD_WORKERS", 8))
+        self._download_per_host = int(os.environ.get("DOWNLOAD_PER_HOST", 4))
+        self._download_max_attempts = int(os.environ.get("DOWNLOAD_MAX_ATTEMPTS", 3))
+        self._course_workers = int(os.environ.get("COURSE_WORKERS", 4))
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+        # Size the connection pools so parallel downloads and feed fetches
+        # can share the session. Each course worker keeps its feed response
+        # streaming while it makes show-more requests, so it needs two.
+        self.session = create_session(
+            pool_maxsize=self._download_workers + 2 * self._course_workers + 1,
+            timeout=timeout,
+            headers=headers)
+        self._pdf_workers = int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
+        # Worker pools are shared by all courses and started on first use
+        self._download_executor = None
+        self._pdf_executor = None
+        self._executors_lock = threading.Lock()
+        self._pending_feed_states = {}
+        self._pending_feed_states_lock = threading.Lock()
+        self._incremental = os.environ.get("INCREMENTAL", "1") == "1"
+        self._incremental_stop_after = int(
+            os.environ.get("INCREMENTAL_STOP_AFTER", 5))
+        self._feed_parser = get_feed_parser()
+        self.attachments = AttachmentStore(Path().resolve() / 'attachments')
+        self._inline_images = os.environ.get("INLINE_IMAGES", "1") == "1"
+        self._image_max_bytes = int(os.environ.get("IMAGE_MAX_KB", 1024)) * 1024
+        self._image_max_dimension = int(os.environ.get("IMAGE_MAX_DIMENSION", 1280))
+        self.images = ImageStore(Path().resolve() / 'images')
+        self._image_fetches = {}
+        self._image_fetches_lock = threading.Lock()
+        # Reentrant, a fetch that is already done forgets itself right away
+        self._attachment_fetches = {}
+        self._attachment_fetches_lock = threading.RLock()
+        self.state = StateStore(Path('.sadc.db'),
+                                legacy_config_file=Path('.sadc.conf'))
 
     def __del__(self) -> None:
         pass
 
-    def _save_config(self) -> None:
-        self._logger.info(f"Saving config file to {self._config_file}")
-        with open(self._config_file, 'w') as f:
-            json.dump(self.config, f, indent=2, ensure_ascii=False)
-
-    def _load_config(self) -> None:
-        if self._config_file.exists():
-            self._logger.info(f"Loading config from {self._config_file}")
-            with open(self._config_file, 'r') as f:
-                self.config = json.load(f)
-        else:
-            self._logger.info(
-                f"Config file not found, initializing default config")
-            self.config = {'course_id': '', 'downloaded': {}, 'updates': {}}
+    def _get_executors(self):
+        with self._executors_lock:
+            if self._download_executor is None:
+                self._download_executor = ThreadPoolExecutor(
+                    max_workers=self._download_workers)
+                self._pdf_executor = self._new_pdf_executor()
+            return self._download_executor, self._pdf_executor
+
+    def _new_pdf_executor(self):
+        return ProcessPoolExecutor(max_workers=self._pdf_workers,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def _run_in_process(self, pdf_executor, fn, *args):
+        """
+        Run fn in the process pool and return its result.
+
+        A worker that dies, e.g. killed for running out of memory, breaks
+        the whole pool. It is then replaced and fn is retried once.
+        """
+        try:
+            return pdf_executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            self._logger.warning("Process pool is broken, starting a new one")
+            metrics.incr('process_pool_restarts')
+            with self._executors_lock:
+                # Other threads may have replaced it already
+                if self._pdf_executor is pdf_executor:
+                    pdf_executor.shutdown(wait=False)
+                    self._pdf_executor = self._new_pdf_executor()
+                pdf_executor = self._pdf_executor
+            return pdf_executor.submit(fn, *args).result()
+
+    def close(self) -> None:
+        if self._download_executor is not None:
+            self._download_executor.shutdown()
+            self._pdf_executor.shutdown()
+            self._download_executor = None
+            self._pdf_executor = None
+        self._quit_driver()
+        self.state.close()
+
+    @property
+    def driver(self):
+        """Chrome is only started the first time an interactive login needs it."""
+        if self._driver is None:
+            from selenium import webdriver
+            from selenium.webdriver.chrome.options import Options
+
+            self._logger.info("Starting Chrome ...")
+            options = Options()
+            options.add_argument("--no-sandbox")
+            options.add_argument('--disable-dev-shm-usage')
+            options.add_argument('--disable-search-engine-choice-screen')
+            options.add_argument('--disable-gpu')
+            if self._headless:
+                options.add_argument("--headless=new")
+            self._driver = webdriver.Chrome(options=options)
+        return self._driver
+
+    def _quit_driver(self) -> None:
+        if self._driver is not None:
+            self._driver.quit()
+            self._driver = None
+
+    def _set_session_cookies(self, cookies) -> None:
+        for cookie in cookies:
+            self.session.cookies.set(cookie['name'],
+                                     cookie['value'],
+                                     domain=cookie.get('domain', ''),
+                                     path=cookie['path'])
 
     def _save_cookies(self, cookie_file: str) -> None:
         self._logger.info(f"Saving cookies to {cookie_file} ...")
         cookies = self.driver.get_cookies()
-        # pickle.dump(cookies, open(cookie_file,"wb"))
         for cookie in cookies:
             if 'expiry' in cookie:
                 cookie['expires'] = cookie['expiry']
                 del cookie['expiry']
-            self.session.cookies.set(cookie['name'],
-                                     cookie['value'],
-                                     path=cookie['path'])
+        self._set_session_cookies(cookies)
+        with open(cookie_file, "wb") as f:
+            pickle.dump(cookies, f)
 
     def _load_cookies(self, cookie_file: str) -> None:
         self._logger.info(f"Loading cookies from {cookie_file}")
-        cookies = pickle.load(open(cookie_file, "rb"))
-        self.driver.execute_cdp_cmd('Network.enable', {})
-        for cookie in cookies:
-            if 'expiry' in cookie:
-                cookie['expires'] = cookie['expiry']
-                del cookie['expiry']
-            self.driver.execute_cdp_cmd('Network.setCookie', cookie)
-            self.session.cookies.set(cookie['name'],
-                                     cookie['value'],
-                                     path=cookie['path'])
-        self.driver.execute_cdp_cmd('Network.disable', {})
-
-    def _wait(self, seconds: int) -> None:
-        self._logger.info(f"Wait for {seconds} seconds ...")
-        time.sleep(seconds)
+        with open(cookie_file, "rb") as f:
+            cookies = pickle.load(f)
+        self._set_session_cookies(cookies)
+
+    def _session_is_valid(self) -> bool:
+        """Cheap HTTP probe: a logged in session gets the home page, otherwise a redirect to login."""
+        if not self.state.get_meta('course_id'):
+            return False
+        try:
+            with self.session.get(f"{self._base_url}/home",
+                                  stream=True,
+                                  allow_redirects=False,
+                                  timeout=self._timeout) as r:
+                return r.status_code == 200
+        except requests.RequestException as e:
+            self._logger.warning(f"Session probe failed: {e}")
+            return False
+
+    def _wait_until(self, condition):
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        return WebDriverWait(self.driver, self._timeout).until(condition)
+
+    def _wait_for_page_load(self) -> None:
+        self._wait_until(lambda driver: driver.execute_script(
+            "return document.readyState") == "complete")
+
+    def _click_and_wait(self, element) -> None:
+        """Click an element that navigates away and wait until the next page is loaded."""
+        from selenium.webdriver.support import expected_conditions as EC
+
+        element.click()
+        self._wait_until(EC.staleness_of(element))
+        self._wait_for_page_load()
+
+    @contextmanager
+    def _host_slot(self, url: str):
+        """Limit the number of concurrent downloads against a single host."""
+        host = urlparse(url).netloc
+        with self._host_slots_lock:
+            slot = self._host_slots.setdefault(
+                host, threading.BoundedSemaphore(self._download_per_host))
+        with slot:
+            yield
+
+    def _media_is_unchanged(self, url: str, entry: dict) -> bool:
+        # Without validators the only cheap check left is a HEAD request
+        # comparing the size of the stored copy
+        with self._host_slot(url), self.session.head(url,
+                                                     allow_redirects=True) as r:
+            if r.status_code != 200 or 'content-length' not in r.headers:
+                return False
+            return int(r.headers['content-length']) == entry['size']
+
+    def download_media(self, url: str) -> Path:
+        entry = self.attachments.lookup(url)
+        headers = {'Accept-Encoding': 'identity'}
+        if entry:
+            conditional_headers = self.attachments.conditional_headers(entry)
+            if not conditional_headers and self._media_is_unchanged(url, entry):
+                self._logger.info(f"{url} already downloaded, skip ...")
+                metrics.incr('downloads_not_modified')
+                return self.attachments.path_of(entry)
+            headers.update(conditional_headers)
+
+        # Partial downloads are kept under a name derived from the url so an
+        # interrupted transfer can be resumed with a Range request next time
+        part_path = self.attachments.partial_path(url)
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        if offset:
+            validator = self.attachments.partial_validator(url)
+            if validator:
+                # A file that changed since is sent whole instead of its tail
+                headers['Range'] = f"bytes={offset}-"
+                headers['If-Range'] = validator
+            else:
+                self._logger.info(f"Partial download for {url} cannot be validated, restarting ...")
+                self.attachments.discard_partial(url)
+                offset = 0
+
+        with self._host_slot(url), self.session.get(url,
+                                                    headers=headers,
+                                                    stream=True,
+                                                    allow_redirects=True) as r:
+            if r.status_code == 304:
+                self._logger.info(f"{url} not modified, skip ...")
+                metrics.incr('downloads_not_modified')
+                return self.attachments.path_of(entry)
+            if r.status_code == 416:
+                self._logger.info(f"Stale partial download for {url}, restarting ...")
+                self.attachments.discard_partial(url)
+                return self.download_media(url)
+            r.raise_for_status()
 
-    def download_media(self, url: str, download_path: Path=Path().resolve()) -> Path:
-        with self.session.get(url, stream=True, allow_redirects=True) as r:
             if 'content-disposition' not in r.headers:
-                fname = ''.join(random.choices(ascii_lowercase + digits, k=16))
+                fname = Path(urlparse(url).path).name or 'attachment'
             else:
                 d = r.headers['content-disposition']
                 fname = re.findall('filename="(.+)"', d)[0]
                 fname = fname.replace('/', '.')
 
-            full_path = download_path / fname
+            self._logger.info(f"Downloading media {url} ({fname}) ...")
 
-            self._logger.info(f"Downloading media {url} to {full_path} ...")
-
-            if full_path.exists():
-                self._logger.info(f"{full_path} already downloaded, skip ...")
-                return full_path
+            if r.status_code == 206:
+                self._logger.info(f"Resuming {url} from byte {offset} ...")
+                mode = "ab"
+            else:
+                mode = "wb"
+                self.attachments.start_partial(url, r.headers)
 
-            with open(full_path, "wb") as f:
+            with open(part_path, mode) as f:
+                start = f.tell()
                 r.raw.decode_content = True
                 shutil.copyfileobj(r.raw, f)
+                metrics.incr('download_bytes', f.tell() - start)
+
+            return self.attachments.add(url, part_path, fname, r.headers)
+
+    def _fetch_attachment(self, url: str, pdf_executor) -> dict:
+        """Download an attachment, return its full_path and the text of a PDF."""
+        with metrics.span('download'):
+            full_path = str(self.download_media(url=url))
+        fetched = {'full_path': full_path}
+        if full_path.lower().endswith('pdf'):
+            # Text extraction is CPU bound, so it runs in a separate process
+            with metrics.span('pdf_extract'):
+                fetched['text'] = self._run_in_process(pdf_executor, extract_text_from_pdf,
+                                                       full_path)
+        return fetched
+
+    def _submit_attachment(self, url: str, executor, pdf_executor):
+        """
+        Start fetching an attachment and return its future.
+
+        An attachment already being fetched shares that future, so two
+        downloads never write the same partial file at once.
+        """
+        with self._attachment_fetches_lock:
+            future = self._attachment_fetches.get(url)
+            if future is None:
+                future = executor.submit(self._fetch_attachment, url, pdf_executor)
+                self._attachment_fetches[url] = future
+                future.add_done_callback(
+                    lambda done: self._forget_attachment_fetch(url, done))
+        return future
+
+    def _forget_attachment_fetch(self, url: str, future) -> None:
+        with self._attachment_fetches_lock:
+            if self._attachment_fetches.get(url) is future:
+                del self._attachment_fetches[url]
+
+    def _fetch_image(self, src: str, pdf_executor) -> Path:
+        path = self.images.lookup(src)
+        if path:
+            return path
+        url = urljoin(self._base_url + '/', src)
+        with metrics.span('image_fetch'), self._host_slot(url), \
+                self.session.get(url, allow_redirects=True) as r:
+            r.raise_for_status()
+            content_type = r.headers.get('content-type', '')
+            if not content_type.startswith('image/'):
+                raise ValueError(f"got {content_type or 'no content type'} instead of an image")
+            data = r.content
+        metrics.incr('image_bytes', len(data))
+        # Decoding is CPU and memory heavy, so it runs in a separate process
+        with metrics.span('image_downscale'):
+            data, ext = self._run_in_process(pdf_executor, downscale_image, data,
+                                             self._image_max_dimension)
+        return self.images.add(src, data, ext)
+
+    def prefetch_images(self, srcs) -> None:
+        """Start fetching images in the background, each at most once per run."""
+        if not self._inline_images:
+            return
+        executor, pdf_executor = self._get_executors()
+        with self._image_fetches_lock:
+            for src in srcs:
+                if src and not src.startswith('data:') and src not in self._image_fetches:
+                    self._image_fetches[src] = executor.submit(self._fetch_image, src,
+                                                               pdf_executor)
+
+    def fetch_images(self, srcs) -> dict:
+        """
+        Return {src: path} of the images that can be sent inline.
+
+        Waits for the fetches started by prefetch_images(), which has to be
+        called with the session of the post's child. Images that were not
+        prefetched, failed to download or are larger than IMAGE_MAX_KB
+        after downscaling are left out, so the email keeps linking to them.
+        """
+        images = {}
+        for src in srcs:
+            with self._image_fetches_lock:
+                future = self._image_fetches.get(src)
+            if future is None:
+                continue
+            try:
+                path = future.result()
+            except Exception as e:
+                self._logger.warning(f"Failed to fetch image {src}: {e}")
+                # Forget the failure so a later run can try again
+                with self._image_fetches_lock:
+                    self._image_fetches.pop(src, None)
+                continue
+            if path.stat().st_size > self._image_max_bytes:
+                self._logger.info(f"Image {src} is too large to send inline")
+                continue
+            images[src] = path
+        return images
+
+    def switch_child(self, child_id: str) -> None:
+        self._logger.info(f"Switching to child {child_id} ...")
+        with self.session.get(f"{self._base_url}/parent/switch_child/{child_id}",
+                              allow_redirects=True) as r:
+            r.raise_for_status()
+
+    def _discover_courses(self):
+        courses = []
+        with self.session.get(f"{self._base_url}/home") as r:
+            r.raise_for_status()
+            child_ids = list(dict.fromkeys(
+                re.findall(r'/parent/switch_child/(\d+)', r.text)))
+        for child_id in child_ids or ['']:
+            if child_id:
+                self.switch_child(child_id)
+            with self.session.get(f"{self._base_url}/courses") as r:
+                r.raise_for_status()
+                found = dict(re.findall(r'href="/course/(\d+)[^"]*"[^>]*>([^<]+)<', r.text))
+            for course_id, name in found.items():
+                self._logger.info(f"Found course {course_id} ({name.strip()}) for child {child_id or 'default'}")
+                courses.append({'child_id': child_id,
+                                'course_id': course_id,
+                                'name': name.strip()})
+        return courses
+
+    def get_courses(self):
+        """
+        Return the courses to fetch as dicts with child_id, course_id and name.
+
+        SCHOOLOGY_COURSES selects them: unset for the homeroom course found at
+        login, "all" to enumerate every child and course of the account, or a
+        comma separated list of course ids of the current child.
+        """
+        configured = os.environ.get("SCHOOLOGY_COURSES", "").strip()
+        if not configured:
+            return [{'child_id': '',
+                     'course_id': self.state.get_meta('course_id'),
+                     'name': ''}]
+        if configured == 'all':
+            return self._discover_courses()
+        return [{'child_id': '', 'course_id': course_id.strip(), 'name': course_id.strip()}
+                for course_id in configured.split(',') if course_id.strip()]
+
+    def get_all_updates(self, courses):
+        """
+        Fetch the feeds of all courses and return a list of (course, posts).
+
+        Children are switched one after another since the session can only
+        view one child at a time. The courses of a child are fetched
+        concurrently, at most COURSE_WORKERS at once, and the child of every
+        course is kept in the state for posts resumed by a later run.
+
+        A course whose feed fails is logged and returns no posts, its feed
+        state is not committed so the next run fetches it again. An expired
+        session fails every course and is raised.
+        """
+        results = []
+        child_ids = list(dict.fromkeys(course['child_id'] for course in courses))
+        for child_id in child_ids:
+            child_courses = [course for course in courses if course['child_id'] == child_id]
+            if child_id:
+                self.switch_child(child_id)
+                for course in child_courses:
+                    self.state.set_meta(f"child:{course['course_id']}", child_id)
+            with ThreadPoolExecutor(max_workers=self._course_workers) as executor:
+                feeds = list(executor.map(self._get_course_updates, child_courses))
+            results.extend(zip(child_courses, feeds))
+            # Images are fetched with the session of this child, so they have
+            # to be done before switching to the next one
+            self.fetch_images([src for posts in feeds for post in posts for src in post['images']])
+        return results
+
+    def _get_course_updates(self, course):
+        try:
+            return self.get_updates(course['course_id'])
+        except SessionExpiredError:
+            raise
+        except Exception:
+            self._logger.exception(f"Failed to fetch the feed of course {course['course_id']}")
+            metrics.incr('feed_failures')
+            with self._pending_feed_states_lock:
+                self._pending_feed_states.pop(course['course_id'], None)
+            return []
+
+    def get_updates(self, course_id: str = None):
+        """
+        Fetch and parse the feed of a course.
+
+        The feed is requested conditionally with the validators of the last
+        fully processed fetch, and a fingerprint of its newest post ids is
+        compared as soon as they have arrived, so an unchanged feed returns
+        [] without reading or parsing the rest. Otherwise the feed is
+        decoded and parsed while it streams in, and work on the first posts
+        starts before the last byte has arrived. Call commit_feed_state()
+        once the returned posts are processed.
+        """
+        course_id = course_id or self.state.get_meta('course_id')
+        feed_state = json.loads(self.state.get_meta(f"feed:{course_id}", '{}'))
+        headers = {}
+        if feed_state.get('etag'):
+            headers['If-None-Match'] = feed_state['etag']
+        if feed_state.get('last_modified'):
+            headers['If-Modified-Since'] = feed_state['last_modified']
 
-            return full_path
-
-    def get_updates(self):
-        course_id = self.config['course_id']
         with self.session.get(
                 f"{self._base_url}/course/{course_id}/feed?filter=1",
+                headers=headers,
                 stream=True,
                 allow_redirects=True) as r:
-            r.raw.decode_content = True
-            result = r.raw.data.decode('unicode-escape').replace(
-                '\\/', '/')
-            posts = self.parse_posts(result)
+            with metrics.span('feed_fetch'):
+                if r.status_code == 304:
+                    self._logger.info(f"Feed of course {course_id} not modified")
+                    metrics.incr('feeds_not_modified')
+                    return []
+                r.raise_for_status()
+                chunks = r.iter_content(FEED_CHUNK_BYTES)
+                # Read ahead only until the newest post ids are known
+                head, post_ids = _read_post_ids(chunks, FINGERPRINT_POST_IDS)
+
+            if not post_ids and not self._session_is_valid():
+                raise SessionExpiredError("Schoology session expired")
+            fingerprint = hashlib.sha256(b','.join(post_ids)).hexdigest()
+            if fingerprint == feed_state.get('fingerprint'):
+                self._logger.info(f"Feed of course {course_id} unchanged, skip parsing")
+                metrics.incr('feeds_unchanged')
+                return []
+            with self._pending_feed_states_lock:
+                self._pending_feed_states[course_id] = {
+                    'etag': r.headers.get('etag', ''),
+                    'last_modified': r.headers.get('last-modified', ''),
+                    'fingerprint': fingerprint,
+                }
+
+            # Journaled posts are never parsed again, unfinished ones are
+            # resumed from the journal instead
+            stop_after = self._incremental_stop_after if self._incremental else 0
+            with metrics.span('parse_posts'):
+                posts = self.parse_posts(_iter_feed_html(itertools.chain(head, chunks)),
+                                         known_ids=self.state.seen_ids(),
+                                         stop_after=stop_after,
+                                         course_id=course_id)
             return posts
 
-    
-    def _get_file_size_in_mb(self, file_path):
-        return os.path.getsize(file_path) / (1024 * 1024)  # Convert bytes to MB
-
-    def parse_posts(self, html):
-        soup = BeautifulSoup(html, 'html.parser')
-        posts = soup.find_all('li', {'class': ['first', '']})
-
+    def commit_feed_state(self, course_id: str) -> None:
+        """Remember the last fetched feed of a course as fully processed."""
+        with self._pending_feed_states_lock:
+            feed_state = self._pending_feed_states.pop(course_id, None)
+        if feed_state:
+            self.state.set_meta(f"feed:{course_id}", json.dumps(feed_state))
+
+    def parse_posts(self, html, known_ids=None, stop_after=0, course_id=None):
+        """
+        Parse the course feed into post dicts.
+
+        html is the feed html, either as a string or as an iterable of text
+        chunks that are parsed as they come.
+
+        Posts whose id is in known_ids are skipped before any show-more
+        request or attachment download is made. The feed is ordered newest
+        first, so once stop_after consecutive known posts have been seen the
+        rest of the feed is assumed to be processed already and is not walked.
+        With a course_id, every post is journaled as parsed and then as
+        downloaded once its attachments are fetched. Posts with an attachment
+        that failed to download are left parsed and not returned, until
+        should_retry_downloads() gives up on the attachment.
+        """
+        known_ids = known_ids or set()
         parsed_posts = []
 
-        for post in posts:
-            # Extract post id
-            post_id = post.get('id', '').replace('edge-assoc-', '')
-
-            # Extract date and time
-            post_datetime = post.find('span', {'class': 'small gray'})
-            post_datetime = post_datetime.text if post_datetime else ''
-
-            # Extract author's name and profile picture
-            author = post.find('a', {'title': 'View user profile.'})
-            author_name = author.text if author else ''
-
-            profile_pic = post.find(
-                'img', {'class': 'imagecache imagecache-profile_sm'})
-            profile_pic_url = profile_pic.get('src', '') if profile_pic else ''
-
-            # Extract main content
-            content_span = post.find('span', {'class': 'update-body s-rte'})
-            html_content = content_span.prettify() if content_span else ''
-
-            content = content_span.get_text() if content_span else ''
-
-            # Check if there is a "Show More" link
-            show_more_link = post.find('a', {'class': 'show-more-link'})
-            show_more_href = show_more_link.get(
-                'href', '') if show_more_link else ''
-
-            images = [img.get('src', '')
-                      for img in content_span.find_all('img')]
-
-            if show_more_href:
-                logging.info(
-                    f"Loading additional content for post {post_id} ...")
-                with self.session.post(f"{self._base_url}{show_more_href}",
-                                       stream=True,
-                                       allow_redirects=True) as r:
-                    if r.status_code == 200:
-                        data = r.json()['update']
-                        # Parse the additional content using BeautifulSoup
-                        additional_content_soup = BeautifulSoup(
-                            data, 'html.parser')
-                        html_content = additional_content_soup.prettify()
-                        content = additional_content_soup.get_text()
-                        images = [
-                            img.get('src', '') for img in additional_content_soup.find_all('img')]
-
-
-            attachments_div = post.find('div', {'class': 'attachments clearfix'})
-            
-            attachments = []
-            
-            # Only proceed if attachments_div is found
-            if attachments_div:
-                attachments_html_content = attachments_div.prettify()
-
-                for a in attachments_div.find_all('a'):
-                    href = a.get('href')  # Get the href attribute (attachment link)
-                    url = self._base_url + href
-        
-                    # Find the first <span> child within the <a> tag
-                    span = a.find('span')
-                    if span:
-                        filename = span.get('aria-label')  # Get the aria-label attribute (attachment filename)
-                        attachments.append({'url': url, 'filename': filename})
-            else:
-                attachments_html_content = ''
-
-            cwd = Path().resolve()
-            attachment_download_path = cwd / 'attachments'
-
-            for attachment in attachments:
-                full_path = str(self.download_media(url=attachment['url'], download_path=attachment_download_path))
-                attachment['full_path'] = full_path
-                if full_path.lower().endswith('pdf') and self._get_file_size_in_mb(full_path) <= 20:  # Only process files less than 20MB
-                    text = extract_text_from_pdf(full_path)
-                    attachment['text'] = text
-
-            parsed_posts.append({
-                'post_id': post_id,
-                'datetime': post_datetime,
-                'author': author_name,
-                'profile_pic_url': profile_pic_url,
-                'content': content.strip(),
-                'html_content': html_content,
-                'attachments_html_content': attachments_html_content,
-                'show_more_href': show_more_href,
-                'images': images,
-                'attachments': attachments
-            })
-
+        # Attachments are fetched in the background while the rest of the
+        # feed (including show-more requests) is still being parsed
+        executor, pdf_executor = self._get_executors()
+        downloads = []
+        known_run = 0
+        if isinstance(html, str):
+            feed_posts = self._feed_parser.iter_posts(html)
+        else:
+            feed_posts = self._feed_parser.iter_posts_stream(html)
+        for post in feed_posts:
+            if post['post_id'] in known_ids:
+                known_run += 1
+                if stop_after and known_run >= stop_after:
+                    self._logger.info(
+                        f"Reached {known_run} already processed posts, stop walking the feed")
+                    break
+                continue
+            known_run = 0
+            metrics.incr('posts_parsed')
+
+            parsed_post = self._expand_post(post)
+            if course_id is not None:
+                self.state.mark(parsed_post['post_id'], STATUS_PARSED,
+                                parsed_post, course_id=course_id)
+            self.prefetch_images(parsed_post['images'])
+            for attachment in parsed_post['attachments']:
+                downloads.append((attachment,
+                                  self._submit_attachment(attachment['url'],
+                                                          executor,
+                                                          pdf_executor)))
+            parsed_posts.append(parsed_post)
+
+        failed_urls = {attachment['url'] for attachment in self._wait_for_downloads(downloads)}
+        incomplete = []
+        for parsed_post in parsed_posts:
+            post_failed = [attachment for attachment in parsed_post['attachments']
+                           if attachment['url'] in failed_urls]
+            if post_failed and self.should_retry_downloads(parsed_post, post_failed):
+                incomplete.append(parsed_post)
+                if course_id is not None:
+                    self.state.mark(parsed_post['post_id'], STATUS_PARSED,
+                                    parsed_post, course_id=course_id)
+        if incomplete:
+            # Posts missing an attachment stay parsed in the journal and are
+            # resumed by the next run, which also fetches the feed again
+            self._logger.warning(f"{len(incomplete)} posts have attachments that failed "
+                                 "to download, they are retried next run")
+            parsed_posts = [parsed_post for parsed_post in parsed_posts
+                            if parsed_post not in incomplete]
+            if course_id is not None:
+                with self._pending_feed_states_lock:
+                    self._pending_feed_states.pop(course_id, None)
+        if course_id is not None:
+            for parsed_post in parsed_posts:
+                self.state.mark(parsed_post['post_id'], STATUS_DOWNLOADED,
+                                parsed_post, course_id=course_id)
         return parsed_posts
 
+    def _wait_for_downloads(self, downloads) -> list:
+        """Wait for the (attachment, future) downloads, return the attachments that failed."""
+        failed = []
+        for attachment, future in downloads:
+            try:
+                attachment.update(future.result())
+            except Exception as e:
+                self._logger.warning(
+                    f"Failed to download attachment {attachment['url']}: {e}")
+                failed.append(attachment)
+        return failed
+
+    def fetch_attachments(self, attachments) -> list:
+        """Download the attachments of a post and extract their text, return the ones that failed."""
+        executor, pdf_executor = self._get_executors()
+        return self._wait_for_downloads([
+            (attachment, self._submit_attachment(attachment['url'], executor, pdf_executor))
+            for attachment in attachments])
+
+    def should_retry_downloads(self, post, failed) -> bool:
+        """
+        Count a failed attempt to download the attachments of a post.
+
+        Returns True while the post has attempts left, so it is retried by
+        the next run. After DOWNLOAD_MAX_ATTEMPTS attempts the failed
+        attachments are given up on, a note about them is added to the
+        post's html and False is returned so the post is sent without them.
+        The attempt count is kept in the post, journal it with the post.
+        """
+        post['download_attempts'] = post.get('download_attempts', 0) + 1
+        if post['download_attempts'] < self._download_max_attempts:
+            return True
+        self._logger.warning(f"Giving up on {len(failed)} attachments of post {post['post_id']} "
+                             f"after {post['download_attempts']} attempts, sending it without them")
+        metrics.incr('attachments_given_up', len(failed))
+        post['html_content'] += ''.join(
+            f"\n<p>The attachment {escape(attachment['filename'])} could not be downloaded, "
+            "open it on Schoology.</p>"
+            for attachment in failed)
+        return False
+
+    def _expand_post(self, post):
+        """Load show-more content and resolve attachment urls of a parsed post."""
+        if post['show_more_href']:
+            logging.info(
+                f"Loading additional content for post {post['post_id']} ...")
+            with metrics.span('show_more'), self.session.post(
+                    f"{self._base_url}{post['show_more_href']}",
+                    stream=True,
+                    allow_redirects=True) as r:
+                if r.status_code == 200:
+                    data = r.json()['update']
+                    html_content, content, images = self._feed_parser.parse_fragment(data)
+                    post['html_content'] = html_content
+                    post['content'] = content
+                    post['images'] = images
+
+        post['content'] = post['content'].strip()
+        # "Today at" is resolved now, the post may be sent on a later day
+        try:
+            post['post_date'] = convert_to_date(post['datetime']).isoformat()
+        except ValueError:
+            self._logger.warning(f"Unrecognized date {post['datetime']!r} of post {post['post_id']}")
+        post['attachments'] = [
+            {'url': self._base_url + attachment['href'],
+             'filename': attachment['filename']}
+            for attachment in post['attachments']
+        ]
+        return post
+
     def schoology_login(self, email: str, password: str) -> None:
         schoology_cookie_file = 'schoology_cookies.pkl'
 
         if os.path.exists(schoology_cookie_file) and os.path.isfile(
                 schoology_cookie_file):
             self._load_cookies(schoology_cookie_file)
-            return
+            if self._session_is_valid():
+                self._logger.info("Saved session is still valid, skip login")
+                return
+            self._logger.info("Saved session expired, logging in again")
+            self.session.cookies.clear()
+            os.remove(schoology_cookie_file)
+
+        # Each step performs its action and then waits only on the condition
+        # that shows the next page is ready, instead of sleeping
+        steps = [
+            ("open login page", self._login_open),
+            ("enter email", lambda: self._login_enter_email(email)),
+            ("enter password", lambda: self._login_enter_password(password)),
+            ("stay signed in", self._login_stay_signed_in),
+            ("switch to child", self._login_switch_child),
+            ("open homeroom", self._login_open_homeroom),
+        ]
+        self.login_timings = {}
+        for name, step in steps:
+            start = time.monotonic()
+            self._logger.info(f"Login step: {name} ...")
+            step()
+            self.login_timings[name] = time.monotonic() - start
+            metrics.observe(f"login_{name.replace(' ', '_')}", self.login_timings[name])
+            self._logger.info(f"Login step: {name} took {self.login_timings[name]:.1f}s")
+        self._logger.info(
+            f"Login finished in {sum(self.login_timings.values()):.1f}s")
 
-        self.driver.get(self._base_url)
+        self._save_cookies(schoology_cookie_file)
 
-        self._logger.info("Loading the login page")
+        self._quit_driver()
 
-        self._wait(5)
+    def _login_open(self) -> None:
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
 
-        email_input = WebDriverWait(self.driver, self._timeout).until(
-            EC.presence_of_element_located((By.NAME, "loginfmt")))
+        self.driver.get(self._base_url)
+        self._wait_until(EC.element_to_be_clickable((By.NAME, "loginfmt")))
 
-        next_button = WebDriverWait(self.driver, self._timeout).until(
-            EC.presence_of_element_located((By.ID, "idSIButton9")))
+    def _login_enter_email(self, email: str) -> None:
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
 
-        self._logger.info("Filling in the email")
+        email_input = self._wait_until(
+            EC.element_to_be_clickable((By.NAME, "loginfmt")))
+        next_button = self._wait_until(
+            EC.element_to_be_clickable((By.ID, "idSIButton9")))
 
         email_input.clear()
         email_input.send_keys(email)
         next_button.click()
 
-        self._wait(5)
+        # The password form is rendered on the same page
+        self._wait_until(EC.element_to_be_clickable((By.NAME, "passwd")))
 
-        password_input = WebDriverWait(self.driver, self._timeout).until(
-            EC.presence_of_element_located((By.NAME, "passwd")))
-        submit_button = WebDriverWait(self.driver, self._timeout).until(
-            EC.presence_of_element_located((By.ID, "idSIButton9")))
+    def _login_enter_password(self, password: str) -> None:
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
 
-        self._logger.info("Filling in the password")
+        password_input = self._wait_until(
+            EC.element_to_be_clickable((By.NAME, "passwd")))
+        submit_button = self._wait_until(
+            EC.element_to_be_clickable((By.ID, "idSIButton9")))
 
         password_input.clear()
         password_input.send_keys(password)
-        submit_button.click()
+        self._click_and_wait(submit_button)
 
-        self._wait(5)
+    def _login_stay_signed_in(self) -> None:
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
 
-        stay_signed_in_button = WebDriverWait(
-            self.driver, self._timeout).until(
-                EC.presence_of_element_located((By.ID, "idSIButton9")))
+        stay_signed_in_button = self._wait_until(
+            EC.element_to_be_clickable((By.ID, "idSIButton9")))
+        self._click_and_wait(stay_signed_in_button)
+        self._wait_until(EC.url_contains(urlparse(self._base_url).netloc))
 
-        self._logger.info(f"Logging in with the email: '{email}'")
+    def _login_switch_child(self) -> None:
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
 
-        stay_signed_in_button.click()
-
-        self._wait(5)
-
-        # Find the button and switch to student account
-        drop_down_menu = WebDriverWait(self.driver, self._timeout).until(
-            EC.presence_of_element_located(
+        drop_down_menu = self._wait_until(
+            EC.element_to_be_clickable(
                 (By.XPATH, '//img[contains(@alt,"Parents of")]')))
-
-        self._logger.info(f"Swiching to children account ...")
-
         drop_down_menu.click()
 
-        self._wait(5)
-
-        # Find the button and switch to student account
-        switch_child_link = WebDriverWait(self.driver, self._timeout).until(
-            EC.presence_of_element_located(
+        switch_child_link = self._wait_until(
+            EC.element_to_be_clickable(
                 (By.XPATH, '//a[contains(@href,"/parent/switch_child/")]')))
+        self._click_and_wait(switch_child_link)
 
-        switch_child_link.click()
-
-        self._wait(5)
+    def _login_open_homeroom(self) -> None:
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
 
-        self._logger.info(f"Opening homeroom course ...")
-        # Find homeroom link
-        homeroom_link = WebDriverWait(self.driver, self._timeout).until(
-            EC.presence_of_element_located(
+        homeroom_link = self._wait_until(
+            EC.element_to_be_clickable(
                 (By.XPATH, '//a[contains(text(),"Homeroom")]')))
-
+        href = homeroom_link.get_attribute('href') or ''
         homeroom_link.click()
+        self._wait_until(EC.url_matches(r"/course/\d+"))
 
-        self._wait(5)
-
-        # Find course id
-        current_url = str(self.driver.current_url)
-        course_id = current_url[36:46]
-        self.config['course_id'] = course_id
-
-        self._save_cookies(schoology_cookie_file)
-
-        self.driver.close()
+        # Prefer the link target, fall back to the url we landed on
+        match = (re.search(r"/course/(\d+)", href)
+                 or re.search(r"/course/(\d+)", self.driver.current_url))
+        course_id = match.group(1)
+        self._logger.info(f"Found course id {course_id}")
+        self.state.set_meta('course_id', course_id)
 
 
 def convert_to_date(date_str):
@@ -346,62 +883,510 @@ def convert_to_date(date_str):
     except ValueError:
         raise ValueError("The provided date string is in an unrecognized format.")
 
+def post_date(post):
+    """Return when a post was posted, as resolved when it was parsed."""
+    if 'post_date' in post:
+        return datetime.fromisoformat(post['post_date'])
+    # Journaled before the date was resolved at parse time
+    return convert_to_date(post['datetime'])
+
+
+def build_update_contents(posts):
+    """
+    Return the content of every post, with the text of its attachments.
+
+    Posts too long for a single summary call have boilerplate repeated
+    across pages and attachments, and attachments shared by several posts,
+    sent only once, with the first post. Shorter ones are sent as they are.
+    """
+    texts = [attachment['text'] for post in posts for attachment in post['attachments']
+             if 'text' in attachment and attachment['text']]
+    if estimate_tokens(''.join(texts + [post['content'] for post in posts])) > SUMMARY_MAX_TOKENS:
+        texts = iter(remove_repeated_lines(texts))
+    else:
+        texts = iter(text.replace(PAGE_BREAK, '') for text in texts)
+    contents = []
+    for post in posts:
+        attachments_text = ''.join('\n' + next(texts) for attachment in post['attachments']
+                                   if 'text' in attachment and attachment['text'])
+        post_datetime = post_date(post).strftime("%b %d, %Y at %I:%M %p")
+        contents.append(f"On {post_datetime}, {post['author']} posted:\n\n"
+                        f"{post['content']}\n\n{attachments_text}")
+    return contents
+
+
+def build_update_content(post):
+    return build_update_contents([post])[0]
+
+
+def embed_images(html_content, images):
+    """
+    Point the <img> tags of html_content that have a fetched image at an inline part.
+
+    images maps an image src to its stored file. Returns the rewritten html
+    and the (content id, path) of every image it now refers to.
+    """
+    content_ids = {}
+
+    def replace(match):
+        path = images.get(unescape(match.group(2)))
+        if path is None:
+            return match.group(0)
+        content_id = content_ids.setdefault(path, f"{path.stem[:32]}@schoology-updates")
+        return f"{match.group(1)}cid:{content_id}{match.group(3)}"
+
+    html_content = re.sub(r'(<img\b[^>]*?\bsrc=")([^"]*)(")', replace, html_content)
+    return html_content, [(content_id, path) for path, content_id in content_ids.items()]
+
+
+def translate_summary(summary, languages):
+    """Translate a summary into every language concurrently."""
+    with metrics.span('translate'), \
+            ThreadPoolExecutor(max_workers=max(len(languages), 1)) as executor:
+        return list(executor.map(lambda language: translate(summary, language),
+                                 languages))
+
+
+def summarize_post(downloader, course, post, status, languages):
+    """
+    Run the stages of a post that come before its email, starting after status.
+
+    status is at least downloaded, fetch_resumed() has fetched the
+    attachments of resumed posts with the session of their child.
+
+    Each finished stage is journaled together with the post, so a later run
+    never repeats it. The post's 'summaries' hold the English summary
+    followed by one translation per language and are returned.
+
+    With SUMMARY_MODE=combined the summary and its translations come from
+    a single call and are journaled together. If that reply cannot be
+    parsed, the post falls back to separate summary and translation calls.
+    """
+    course_id = course['course_id']
+    reached = STAGES.index(status)
+    if 'summaries' not in post:
+        # Posts of a digest that was not sent have no summaries of their own
+        reached = min(reached, STAGES.index(STATUS_DOWNLOADED))
+    if SUMMARY_MODE == 'combined' and reached < STAGES.index(STATUS_SUMMARIZED):
+        try:
+            with metrics.span('summarize_multilingual'):
+                post['summaries'] = summarize_multilingual(build_update_content(post), languages)
+        except ValueError as e:
+            logging.warning(f"Could not parse the combined summary of post {post['post_id']} "
+                            f"({e}), summarizing and translating separately")
+            metrics.incr('summaries_multilingual_fallbacks')
+        else:
+            metrics.incr('summaries_multilingual')
+            downloader.state.mark(post['post_id'], STATUS_TRANSLATED, post, course_id=course_id)
+            return post['summaries']
+    if reached < STAGES.index(STATUS_SUMMARIZED):
+        with metrics.span('summarize'):
+            post['summaries'] = [summarize(build_update_content(post))]
+        downloader.state.mark(post['post_id'], STATUS_SUMMARIZED, post, course_id=course_id)
+    if reached < STAGES.index(STATUS_TRANSLATED):
+        summary = post['summaries'][0]
+        post['summaries'] = [summary] + translate_summary(summary, languages)
+        downloader.state.mark(post['post_id'], STATUS_TRANSLATED, post, course_id=course_id)
+    return post['summaries']
+
+
+def course_email(downloader, course, date_label):
+    """Return the sender, receiver, BCC emails, subject and course url of an email of course."""
+    HOMEROOM_CLASS = os.environ.get("HOMEROOM_CLASS")
+    HOMEROOM_COURSE_URL = os.environ.get("HOMEROOM_COURSE_URL")
+
+    summary_sender_email = os.environ.get("SUMMARY_SENDER_EMAIL")
+    # Courses can be routed to their own receiver
+    summary_receiver_email = os.environ.get(
+        f"SUMMARY_RECEIVER_EMAIL_{course['course_id']}",
+        os.environ.get("SUMMARY_RECEIVER_EMAIL"))
+    if course['name']:
+        subject = f"{course['name']} Updates {date_label}"
+        course_url = f"{downloader._base_url}/course/{course['course_id']}/updates"
+    else:
+        subject = f"{HOMEROOM_CLASS} Homeroom Updates {date_label}"
+        course_url = HOMEROOM_COURSE_URL
+    bcc_emails_env = os.environ.get("BCC_EMAILS")
+    bcc_emails = bcc_emails_env.split(',') if bcc_emails_env else []
+    return summary_sender_email, summary_receiver_email, bcc_emails, subject, course_url
+
+
+def send_journaled(downloader, transport, course, posts, summaries, date_label,
+                   description, failed_course_ids):
+    """
+    Send posts of course and their summaries in one email, journaling the send.
+
+    The posts are marked emailing before the email is sent, so a crash
+    during the send can never lead to it being sent twice. If the server
+    refused it, the posts go back to translated for the next run and the
+    course is added to failed_course_ids. If it may have been delivered,
+    it is not sent again. Returns whether the posts are done.
+    """
+    course_id = course['course_id']
+    summaries_html = [markdown_to_html(summary) for summary in summaries]
+    # Identical attachments are stored once, under the same path
+    attachment_file_paths = list(dict.fromkeys(
+        attachment['full_path'] for post in posts for attachment in post['attachments']
+        if 'text' in attachment and attachment['text']))
+
+    summary_sender_email, summary_receiver_email, bcc_emails, subject, course_url = \
+        course_email(downloader, course, date_label)
+    logging.info(f"Sending {description} from {summary_sender_email} "
+                 f"to {summary_receiver_email} and BCC to {bcc_emails}")
+
+    posts_html = []
+    inline_images = {}
+    for post in posts:
+        # Schoology images need a login, so they are sent along inline
+        post_html, post_images = embed_images(post['html_content'],
+                                              downloader.fetch_images(post['images']))
+        inline_images.update(post_images)
+        post_datetime = post_date(post).strftime("%b %d, %Y at %I:%M %p")
+        posts_html.append(f"On {post_datetime}, {post['author']} posted:"
+                          f"\n<br/><br/>\n{post_html}")
+    html_content = (
+        f"<a href={course_url}>View updates on schoology</a>\n<br/><br/>\n"
+        + '\n<hr/>\n'.join(posts_html)
+        + '\n<hr/>\n'
+        + '\n<hr/>\n'.join(summaries_html)
+    )
+
+    for post in posts:
+        downloader.state.mark(post['post_id'], STATUS_EMAILING)
+    try:
+        send_email(summary_sender_email, summary_receiver_email, bcc_emails, subject,
+                   html_content, attachment_file_paths, transport=transport,
+                   inline_images=list(inline_images.items()))
+    except EmailMaybeDeliveredError as e:
+        logging.warning(f"Not sending {description} again, it may have been sent: {e}")
+        metrics.incr('email_failures')
+    except EmailDeliveryError as e:
+        logging.error(f"Failed to send {description}: {e}")
+        metrics.incr('email_failures')
+        failed_course_ids.add(course_id)
+        for post in posts:
+            downloader.state.mark(post['post_id'], STATUS_TRANSLATED)
+        return False
+    for post in posts:
+        downloader.state.mark(post['post_id'], STATUS_DONE, post, course_id=course_id)
+    return True
+
+
+def email_posts(downloader, pending, transport, languages, llm_post_workers, failed_course_ids):
+    """
+    Summarize the pending (course, post, status) and email every post on its own.
+
+    Returns the number of posts emailed.
+    """
+    processed = 0
+    # Posts are summarized concurrently, but results are consumed in post
+    # order so emails still go out oldest first
+    with ThreadPoolExecutor(max_workers=llm_post_workers) as executor:
+        summaries = [executor.submit(summarize_post, downloader, course, post, status, languages)
+                     for course, post, status in pending]
+
+        for (course, post, _), future in zip(pending, summaries):
+            try:
+                post_summaries = future.result()
+            except Exception:
+                # The journal keeps the stages reached so far for the next run
+                logging.exception(f"Failed to summarize post {post['post_id']}")
+                failed_course_ids.add(course['course_id'])
+                continue
+
+            post_date_ymd = post_date(post).strftime("%Y%m%d")
+            if send_journaled(downloader, transport, course, [post], post_summaries,
+                              post_date_ymd, f"the email of post {post['post_id']}",
+                              failed_course_ids):
+                processed += 1
+    return processed
+
+
+def digest_groups(entries):
+    """
+    Split the pending (post, status) of a course into the posts of each digest.
+
+    Posts whose digest was summarized by an earlier run that stopped before
+    sending it are sent with that digest again, as long as all of its posts
+    are pending. All other posts form one new digest.
+    """
+    pending_ids = {post['post_id'] for post, _ in entries}
+    journaled = {}
+    new = []
+    for post, status in entries:
+        digest = post.get('digest')
+        if digest and STAGES.index(status) >= STAGES.index(STATUS_SUMMARIZED) \
+                and set(digest['post_ids']) <= pending_ids:
+            journaled.setdefault(tuple(digest['post_ids']), []).append((post, status))
+        else:
+            new.append((post, status))
+    groups = []
+    for post_ids, group in journaled.items():
+        if len(group) == len(post_ids):
+            groups.append(group)
+        else:
+            new.extend(group)
+    if new:
+        groups.append(new)
+    return groups
+
+
+def summarize_digest_posts(downloader, course, entries, languages):
+    """
+    Run the stages of a digest that come before its email, like summarize_post().
+
+    The digest, the ids of its posts and its summaries, is journaled with
+    every post as each stage finishes, so a later run never repeats it.
+    Returns the English summary followed by one translation per language.
+    """
+    course_id = course['course_id']
+    posts = [post for post, _ in entries]
+    post_ids = [post['post_id'] for post in posts]
+    reached = min(STAGES.index(status) for _, status in entries)
+    if any(set(post.get('digest', {}).get('post_ids', ())) != set(post_ids) for post in posts):
+        # Posts of an earlier digest that is not complete any more
+        reached = min(reached, STAGES.index(STATUS_DOWNLOADED))
+    if reached < STAGES.index(STATUS_SUMMARIZED):
+        with metrics.span('summarize'):
+            summary = summarize_digest(build_update_contents(posts))
+        digest = {'post_ids': post_ids, 'summaries': [summary]}
+        for post in posts:
+            post['digest'] = digest
+            downloader.state.mark(post['post_id'], STATUS_SUMMARIZED, post, course_id=course_id)
+    if reached < STAGES.index(STATUS_TRANSLATED):
+        summary = posts[0]['digest']['summaries'][0]
+        digest = {'post_ids': post_ids,
+                  'summaries': [summary] + translate_summary(summary, languages)}
+        for post in posts:
+            post['digest'] = digest
+            downloader.state.mark(post['post_id'], STATUS_TRANSLATED, post, course_id=course_id)
+    return posts[0]['digest']['summaries']
+
+
+def email_digests(downloader, pending, transport, languages, failed_course_ids, window_minutes):
+    """
+    Summarize and email the pending (course, post, status) of each course as one digest.
+
+    The posts of a course are summarized in one pass with a section per
+    post and sent in one email that carries every attachment once. With
+    window_minutes set, they wait in the journal until the oldest of them
+    was first seen that long ago, so posts of later runs join the digest.
+
+    Returns the number of posts emailed.
+    """
+    by_course = {}
+    for course, post, status in pending:
+        by_course.setdefault(course['course_id'], (course, []))[1].append((post, status))
+
+    digests = []
+    for course, entries in by_course.values():
+        if window_minutes:
+            oldest = min(downloader.state.first_seen(post['post_id']) for post, _ in entries)
+            if time.time() - oldest < window_minutes * 60:
+                logging.info(f"Holding {len(entries)} posts of course {course['course_id']} "
+                             "for the digest")
+                continue
+        digests.extend((course, group) for group in digest_groups(entries))
+
+    processed = 0
+    for course, entries in digests:
+        course_id = course['course_id']
+        entries.sort(key=lambda entry: post_date(entry[0]))
+        posts = [post for post, _ in entries]
+        try:
+            summaries = summarize_digest_posts(downloader, course, entries, languages)
+        except Exception:
+            # The journal keeps the stages reached so far for the next run
+            logging.exception(f"Failed to summarize the digest of course {course_id}")
+            failed_course_ids.add(course_id)
+            continue
+
+        dates = sorted({post_date(post).strftime("%Y%m%d") for post in posts})
+        date_label = dates[0] if len(dates) == 1 else f"{dates[0]}-{dates[-1]}"
+        if not send_journaled(downloader, transport, course, posts, summaries, date_label,
+                              f"the digest of {len(posts)} posts of course {course_id}",
+                              failed_course_ids):
+            continue
+        metrics.incr('digests_sent')
+        metrics.incr('digest_posts', len(posts))
+        processed += len(posts)
+    return processed
+
+
+def fetch_resumed(downloader, pending, failed_course_ids):
+    """
+    Fetch what the resumed (course, post, status) still need, child by child.
+
+    The session views one child at a time, so the attachments and images
+    of a post are fetched after switching to its child. Posts whose
+    attachments fail again stay in the journal until they run out of
+    attempts. Returns the pending entries that are downloaded, in their
+    original order.
+    """
+    statuses = {}
+    for child_id in dict.fromkeys(course['child_id'] for course, _, _ in pending):
+        entries = [entry for entry in pending if entry[0]['child_id'] == child_id]
+        if child_id:
+            downloader.switch_child(child_id)
+        for course, post, status in entries:
+            if STAGES.index(status) < STAGES.index(STATUS_DOWNLOADED):
+                failed = downloader.fetch_attachments(post['attachments'])
+                if failed and downloader.should_retry_downloads(post, failed):
+                    logging.warning(f"Failed to fetch the attachments of post {post['post_id']}, "
+                                    "it is retried next run")
+                    downloader.state.mark(post['post_id'], STATUS_PARSED, post,
+                                          course_id=course['course_id'])
+                    failed_course_ids.add(course['course_id'])
+                    continue
+                status = STATUS_DOWNLOADED
+                downloader.state.mark(post['post_id'], status, post,
+                                      course_id=course['course_id'])
+            statuses[post['post_id']] = status
+        srcs = [src for _, post, _ in entries for src in post['images']]
+        downloader.prefetch_images(srcs)
+        downloader.fetch_images(srcs)
+    return [(course, post, statuses[post['post_id']]) for course, post, _ in pending
+            if post['post_id'] in statuses]
+
+
+def process_updates(downloader, courses, transport, languages, llm_post_workers):
+    """
+    Fetch the feeds of all courses, then summarize and email every new post.
+
+    Posts left unfinished by an earlier run are resumed from the journal at
+    the stage they reached, before the new ones. A post whose email was
+    being sent when that run stopped is not sent again, so no email goes
+    out twice. With DIGEST_MODE=1 the posts of each course are sent as one
+    digest instead of an email per post.
+
+    Returns the number of posts processed.
+    """
+    DIGEST_MODE = os.environ.get("DIGEST_MODE", "0") == "1"
+    DIGEST_WINDOW_MINUTES = float(os.environ.get("DIGEST_WINDOW_MINUTES", 0))
+
+    courses_by_id = {course['course_id']: course for course in courses}
+    pending = []
+    for post_id, course_id, status, post in downloader.state.unfinished():
+        if status == STATUS_EMAILING:
+            logging.warning(f"The last run stopped while emailing post {post_id}, "
+                            "it may have been sent and is not sent again")
+            downloader.state.mark(post_id, STATUS_DONE)
+            continue
+        course = courses_by_id.get(course_id) or {
+            'child_id': downloader.state.get_meta(f"child:{course_id}"),
+            'course_id': course_id,
+            'name': ''}
+        pending.append((course, post, status))
+    # The feed is journaled newest first, so the journal order is not the
+    # post order
+    pending.sort(key=lambda entry: post_date(entry[1]))
+    if pending:
+        logging.info(f"Resuming {len(pending)} unfinished posts from the journal")
+    metrics.incr('posts_resumed', len(pending))
+    failed_course_ids = set()
+    pending = fetch_resumed(downloader, pending, failed_course_ids)
+
+    new_post_count = 0
+    for course, posts in downloader.get_all_updates(courses):
+        pending.extend((course, post, STATUS_DOWNLOADED) for post in reversed(posts))
+        new_post_count += len(posts)
+    metrics.incr('posts_new', new_post_count)
+
+    if DIGEST_MODE:
+        processed = email_digests(downloader, pending, transport, languages,
+                                  failed_course_ids, DIGEST_WINDOW_MINUTES)
+    else:
+        processed = email_posts(downloader, pending, transport, languages,
+                                llm_post_workers, failed_course_ids)
+
+    for course in courses:
+        if course['course_id'] not in failed_course_ids:
+            downloader.commit_feed_state(course['course_id'])
+    return processed
+
+
+def export_metrics(metrics_file):
+    """Log the metrics collected so far and write them to metrics_file if set."""
+    llm_cache_stats = llm_cache.stats()
+    metrics.set_gauge('llm_cache_hits', llm_cache_stats['hits'])
+    metrics.set_gauge('llm_cache_misses', llm_cache_stats['misses'])
+    metrics.set_gauge('llm_cache_hit_rate', llm_cache_stats['hit_rate'])
+    metrics.log_summary()
+    if metrics_file:
+        try:
+            metrics.export(metrics_file)
+        except OSError as e:
+            logging.warning(f"Failed to write metrics to {metrics_file}: {e}")
+
+
+def watch(downloader, courses, transport, email, password, languages,
+          llm_post_workers, state_payload_retention_days, metrics_file):
+    """Poll the feeds forever, keeping the session, connections and caches warm."""
+    schedule = PollSchedule()
+    logged_in_again = False
+    while True:
+        try:
+            with metrics.span('run'):
+                new_post_count = process_updates(downloader, courses, transport,
+                                                 languages, llm_post_workers)
+            schedule.record(new_post_count > 0)
+            downloader.state.compact(state_payload_retention_days)
+        except SessionExpiredError:
+            if logged_in_again:
+                # Logging in again right away would only start Chrome in a loop
+                logging.error("Session expired right after logging in, trying again later")
+                schedule.record(False)
+            else:
+                logging.info("Session expired, logging in again")
+                try:
+                    with metrics.span('login'):
+                        downloader.schoology_login(email, password)
+                except Exception:
+                    logging.exception("Login failed")
+                    schedule.record(False)
+                else:
+                    # Poll again right away with the new session
+                    logged_in_again = True
+                    continue
+        except Exception:
+            logging.exception("Poll failed")
+            schedule.record(False)
+        logged_in_again = False
+        export_metrics(metrics_file)
+        time.sleep(schedule.next_interval())
+
+
 def main():
     EMAIL = os.environ.get("SCHOOLOGY_EMAIL")
     PASSWORD = os.environ.get("SCHOOLOGY_PASSWORD")
     SUBDOMAIN = os.environ.get("SCHOOLOGY_SUBDOMAIN")
-    HOMEROOM_CLASS = os.environ.get("HOMEROOM_CLASS")
-    HOMEROOM_COURSE_URL = os.environ.get("HOMEROOM_COURSE_URL")
+    LLM_POST_WORKERS = int(os.environ.get("LLM_POST_WORKERS", 4))
+    LANGUAGES = [language.strip() for language in
+                 os.environ.get("SUMMARY_LANGUAGES", "Japanese,Chinese").split(",")
+                 if language.strip()]
+    STATE_PAYLOAD_RETENTION_DAYS = float(
+        os.environ.get("STATE_PAYLOAD_RETENTION_DAYS", 30))
+    WATCH_MODE = os.environ.get("WATCH_MODE", "0") == "1"
+    METRICS_FILE = os.environ.get("METRICS_FILE", "")
 
     downloader = SchoologyAlbumsDownloader(headless=True, subdomain=SUBDOMAIN)
-    downloader.schoology_login(EMAIL, PASSWORD)
-    posts = downloader.get_updates()
-    for post in reversed(posts):
-        if not post['post_id'] in downloader.config['updates']:
-            attachment_file_paths = []
-            attachments_text = ""
-            if post['attachments']:
-                for attachment in post['attachments']:
-                    if 'text' in attachment and attachment['text']:
-                        attachments_text += '\n' + attachment['text']
-                        attachment_file_paths.append(attachment['full_path'])
-
-            dt = convert_to_date(post['datetime'])
-            post_datetime = dt.strftime("%b %d, %Y at %I:%M %p")
-            update_content = f"On {post_datetime}, {post['author']} posted:\n\n{post['content']}\n\n{attachments_text}"
-
-            summary = summarize(update_content)
-            japanese_summary = translate(summary, "Japanese")
-            chinese_summary = translate(summary, "Chinese")
-
-            summary_html = markdown_to_html(summary)
-            japanese_summary_html = markdown_to_html(japanese_summary)
-            chinese_summary_html = markdown_to_html(chinese_summary)
-
-            post_date_ymd = dt.strftime("%Y%m%d")
-            summary_sender_email = os.environ.get("SUMMARY_SENDER_EMAIL")
-            summary_receiver_email = os.environ.get("SUMMARY_RECEIVER_EMAIL")
-            bcc_emails_env = os.environ.get("BCC_EMAILS")
-            bcc_emails = bcc_emails_env.split(',') if bcc_emails_env else []
-            logging.info(f"Sending email from {summary_sender_email} to {summary_receiver_email} and BCC to {bcc_emails}")
-
-
-            # Construct the html content with the attachments section
-            html_content = (
-                f"<a href={HOMEROOM_COURSE_URL}>View updates on schoology</a>\n<br/><br/>\n"
-                + f"On {post['datetime']}, {post['author']} posted:"
-                + '\n<br/><br/>\n' 
-                + post['html_content'] 
-                + '\n<hr/>\n' 
-                + summary_html
-                + '\n<hr/>\n' 
-                + japanese_summary_html
-                + '\n<hr/>\n' 
-                + chinese_summary_html
-            )
-            send_email(summary_sender_email, summary_receiver_email, bcc_emails, f"{HOMEROOM_CLASS} Homeroom Updates {post_date_ymd}", html_content, attachment_file_paths)
-            downloader.config['updates'][post['post_id']] = post
-    downloader._save_config()
+    with metrics.span('login'):
+        downloader.schoology_login(EMAIL, PASSWORD)
+    courses = downloader.get_courses()
+    try:
+        with MailTransport() as transport:
+            if WATCH_MODE:
+                watch(downloader, courses, transport, EMAIL, PASSWORD,
+                      LANGUAGES, LLM_POST_WORKERS, STATE_PAYLOAD_RETENTION_DAYS,
+                      METRICS_FILE)
+            else:
+                with metrics.span('run'):
+                    process_updates(downloader, courses, transport, LANGUAGES,
+                                    LLM_POST_WORKERS)
+        downloader.state.compact(STATE_PAYLOAD_RETENTION_DAYS)
+    finally:
+        downloader.close()
+        export_metrics(METRICS_FILE)
 
 
 if __name__ == "__main__":
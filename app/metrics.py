@@ -0,0 +1,113 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from storage import atomic_write
+
+PROMETHEUS_PREFIX = "schoology_updates"
+
+
+class Metrics:
+    """
+    Timing spans, counters and gauges of a process.
+
+    span() times a stage and keeps its call count, total and slowest
+    duration, incr() adds to a counter such as bytes or tokens, and
+    set_gauge() records a point value such as a cache hit rate. Values are
+    cumulative for the lifetime of the process. Recording only takes a lock
+    and a clock read, so it is always on.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = {}
+        self._counters = {}
+        self._gauges = {}
+        self._logger = logging.getLogger(Metrics.__name__)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            span = self._spans.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            span['count'] += 1
+            span['seconds'] += seconds
+            span['max_seconds'] = max(span['max_seconds'], seconds)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'spans': {stage: dict(span) for stage, span in self._spans.items()},
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+            }
+
+    def to_prometheus(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, samples):
+            if samples:
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+                lines.extend(f"{PROMETHEUS_PREFIX}_{name}{labels} {value}"
+                             for labels, value in samples)
+
+        spans = sorted(snapshot['spans'].items())
+        family('stage_calls_total', 'counter',
+               [(f'{{stage="{stage}"}}', span['count']) for stage, span in spans])
+        family('stage_seconds_total', 'counter',
+               [(f'{{stage="{stage}"}}', f"{span['seconds']:.6f}") for stage, span in spans])
+        family('stage_seconds_max', 'gauge',
+               [(f'{{stage="{stage}"}}', f"{span['max_seconds']:.6f}") for stage, span in spans])
+        for name, value in sorted(snapshot['counters'].items()):
+            family(f"{name}_total", 'counter', [('', value)])
+        for name, value in sorted(snapshot['gauges'].items()):
+            family(name, 'gauge', [('', value)])
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """
+        Write the metrics to path.
+
+        A .json path gets a JSON summary, anything else the Prometheus text
+        format, e.g. for the node exporter textfile collector. The file is
+        replaced atomically so a scraper never reads half of it.
+        """
+        path = Path(path)
+        if path.suffix == '.json':
+            content = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        else:
+            content = self.to_prometheus()
+        atomic_write(path, content)
+
+    def log_summary(self):
+        snapshot = self.snapshot()
+        for stage, span in sorted(snapshot['spans'].items(),
+                                  key=lambda item: -item[1]['seconds']):
+            self._logger.info(f"{stage}: {span['count']} calls, {span['seconds']:.2f}s total, "
+                              f"{span['max_seconds']:.2f}s max")
+        for name, value in sorted(snapshot['counters'].items()):
+            self._logger.info(f"{name}: {value}")
+        for name, value in sorted(snapshot['gauges'].items()):
+            self._logger.info(f"{name}: {value:.2f}")
+
+
+metrics = Metrics()
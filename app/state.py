@@ -0,0 +1,139 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS posts (
+    post_id TEXT PRIMARY KEY,
+    course_id TEXT,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    payload TEXT
+);
+CREATE INDEX IF NOT EXISTS posts_status ON posts (status);
+CREATE INDEX IF NOT EXISTS posts_updated_at ON posts (updated_at);
+"""
+
+# Stages of a post in the order they are journaled. A post is done once
+# its email was sent, emailing is recorded right before sending it.
+STATUS_PARSED = 'parsed'
+STATUS_DOWNLOADED = 'downloaded'
+STATUS_SUMMARIZED = 'summarized'
+STATUS_TRANSLATED = 'translated'
+STATUS_EMAILING = 'emailing'
+STATUS_DONE = 'done'
+STAGES = [STATUS_PARSED, STATUS_DOWNLOADED, STATUS_SUMMARIZED,
+          STATUS_TRANSLATED, STATUS_EMAILING, STATUS_DONE]
+
+
+class StateStore:
+    """
+    SQLite-backed run state.
+
+    Each post is one row keyed by post id with its stage and the post
+    payload, written as a journal while the post moves through STAGES.
+    Every update is committed on its own, so progress made before a crash
+    is kept and an unfinished post resumes at the stage that failed.
+    Payloads of done posts older than the retention period are dropped by
+    compact().
+    """
+
+    def __init__(self, db_file: Path, legacy_config_file: Path = None) -> None:
+        self._logger = logging.getLogger(StateStore.__name__)
+        self._lock = threading.Lock()
+        is_new = not db_file.exists()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+        if is_new and legacy_config_file and legacy_config_file.exists():
+            self._migrate(legacy_config_file)
+
+    def _migrate(self, legacy_config_file: Path) -> None:
+        self._logger.info(f"Migrating state from {legacy_config_file}")
+        with open(legacy_config_file, 'r') as f:
+            config = json.load(f)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ('course_id', config.get('course_id', '')))
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO posts (post_id, status, created_at, updated_at, payload) "
+                "VALUES (?, ?, ?, ?, NULL)",
+                [(post_id, STATUS_DONE, now, now) for post_id in config.get('updates', {})])
+        legacy_config_file.rename(legacy_config_file.with_suffix('.conf.migrated'))
+
+    def get_meta(self, key: str, default: str = '') -> str:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?",
+                                     (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, value))
+
+    def seen_ids(self) -> set:
+        """Ids of all journaled posts, finished or not."""
+        with self._lock:
+            rows = self._conn.execute("SELECT post_id FROM posts").fetchall()
+        return {row[0] for row in rows}
+
+    def unfinished(self) -> list:
+        """Return (post_id, course_id, status, payload) of posts not done yet, in journal order."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT post_id, course_id, status, payload FROM posts "
+                "WHERE status != ? ORDER BY created_at, rowid",
+                (STATUS_DONE,)).fetchall()
+        return [(post_id, course_id, status, json.loads(payload) if payload else None)
+                for post_id, course_id, status, payload in rows]
+
+    def first_seen(self, post_id: str) -> float:
+        """Return when post_id was first journaled, now if it was not."""
+        with self._lock:
+            row = self._conn.execute("SELECT created_at FROM posts WHERE post_id = ?",
+                                     (post_id,)).fetchone()
+        return row[0] if row else time.time()
+
+    def mark(self, post_id: str, status: str, payload: dict = None,
+             course_id: str = None) -> None:
+        now = time.time()
+        payload = json.dumps(payload, ensure_ascii=False) if payload is not None else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO posts (post_id, course_id, status, created_at, updated_at, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (post_id) DO UPDATE SET status = excluded.status, "
+                "course_id = COALESCE(excluded.course_id, posts.course_id), "
+                "updated_at = excluded.updated_at, "
+                "payload = COALESCE(excluded.payload, posts.payload)",
+                (post_id, course_id, status, now, now, payload))
+
+    def compact(self, retention_days: float) -> None:
+        """Drop payloads of done posts not updated within retention_days."""
+        cutoff = time.time() - retention_days * 24 * 3600
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE posts SET payload = NULL "
+                "WHERE status = ? AND updated_at < ? AND payload IS NOT NULL",
+                (STATUS_DONE, cutoff))
+        if cursor.rowcount:
+            self._logger.info(f"Dropped payloads of {cursor.rowcount} old posts")
+            with self._lock:
+                self._conn.execute("VACUUM")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,47 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+
+def atomic_write(path: Path, data) -> None:
+    """
+    Replace the file at path with data, str or bytes, in one step.
+
+    data is written to a temporary file next to path, named after the
+    process and thread so concurrent writers never share one, and renamed
+    over path. A reader sees the old file or the new one, never a part.
+    """
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    if isinstance(data, bytes):
+        tmp_path.write_bytes(data)
+    else:
+        tmp_path.write_text(data)
+    tmp_path.replace(path)
+
+
+class JsonIndex:
+    """
+    Dict kept in a JSON file, such as the index.json of a file store.
+
+    The file is read once and rewritten atomically on every change, under
+    a lock so the index can be shared by download threads.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        if path.exists():
+            with open(path, 'r') as f:
+                self._data = json.load(f)
+        else:
+            self._data = {}
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            atomic_write(self._path, json.dumps(self._data, indent=2, ensure_ascii=False))
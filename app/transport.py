@@ -0,0 +1,220 @@
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from metrics import metrics
+
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_BACKOFF_SECONDS = 30
+MAX_RETRY_AFTER_SECONDS = 60
+
+
+class TokenBucket:
+    """
+    Token bucket allowing rate requests per second with bursts of up to burst.
+
+    acquire() blocks until a token is available.
+    """
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            metrics.observe('http_rate_limit_wait', wait)
+            time.sleep(wait)
+
+
+class RetryBudget:
+    """
+    Caps retries to a ratio of all requests, plus a few to start with.
+
+    When a host is down every request fails, and retrying each of them
+    would multiply the load without helping. The budget lets retries
+    smooth over sporadic failures but not persistent ones.
+    """
+
+    def __init__(self, ratio, min_retries=10):
+        self._ratio = ratio
+        self._min_retries = min_retries
+        self._requests = 0
+        self._retries = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self._requests += 1
+
+    def try_retry(self):
+        """Take a retry from the budget, return False if it is used up."""
+        with self._lock:
+            if self._retries >= self._min_retries + self._ratio * self._requests:
+                return False
+            self._retries += 1
+            return True
+
+
+def _connection_not_made(error):
+    """Return True if a request failed before it was sent, so sending it again is safe."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # A refused connection or failed name lookup is a plain ConnectionError
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _count_read_bytes(raw):
+    # Bodies are mostly streamed, often chunked without a Content-Length,
+    # so bytes are counted as read() or read_chunked() return them
+    read = raw.read
+    read_chunked = getattr(raw, 'read_chunked', None)
+
+    def counting_read(*args, **kwargs):
+        data = read(*args, **kwargs)
+        metrics.incr('http_response_bytes', len(data))
+        return data
+
+    def counting_read_chunked(*args, **kwargs):
+        for data in read_chunked(*args, **kwargs):
+            metrics.incr('http_response_bytes', len(data))
+            yield data
+
+    raw.read = counting_read
+    if read_chunked is not None:
+        raw.read_chunked = counting_read_chunked
+
+
+def _retry_after(response):
+    value = response.headers.get('retry-after')
+    if not value:
+        return 0
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return 0
+    return min(max(seconds, 0), MAX_RETRY_AFTER_SECONDS)
+
+
+class TransportAdapter(HTTPAdapter):
+    """
+    HTTP adapter with a default timeout, retries and per-host rate limits.
+
+    Idempotent requests are retried on connection errors, timeouts and
+    429/5xx responses with exponential backoff and full jitter, honouring
+    Retry-After, for as long as the shared retry budget allows. Other
+    requests are only retried when the connection could not be made, so
+    they are never sent twice. Every request first takes a token from the
+    bucket of its host and is timed in the http_request metric, and the
+    bytes of its response are counted as they are read.
+    """
+
+    def __init__(self, pool_maxsize, timeout, max_retries, backoff, retry_budget,
+                 rate_per_host, burst_per_host):
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._retry_budget = retry_budget
+        self._rate_per_host = rate_per_host
+        self._burst_per_host = burst_per_host
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._logger = logging.getLogger(TransportAdapter.__name__)
+        super().__init__(pool_connections=8, pool_maxsize=pool_maxsize)
+
+    def _bucket(self, host):
+        with self._buckets_lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self._rate_per_host,
+                                                           self._burst_per_host)
+            return bucket
+
+    def _backoff_delay(self, attempt):
+        return random.uniform(0, min(MAX_BACKOFF_SECONDS, self._backoff * 2 ** attempt))
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._timeout
+        host = urlparse(request.url).netloc
+        idempotent = request.method in IDEMPOTENT_METHODS
+        self._retry_budget.record_request()
+        attempt = 0
+        while True:
+            self._bucket(host).acquire()
+            start = time.perf_counter()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.observe('http_request', time.perf_counter() - start)
+                metrics.incr('http_errors')
+                retryable = idempotent or _connection_not_made(e)
+                if not retryable or attempt >= self._max_retries \
+                        or not self._retry_budget.try_retry():
+                    raise
+                reason = type(e).__name__
+                delay = self._backoff_delay(attempt)
+            else:
+                metrics.observe('http_request', time.perf_counter() - start)
+                metrics.incr('http_requests')
+                if response.status_code not in RETRY_STATUSES or not idempotent \
+                        or attempt >= self._max_retries \
+                        or not self._retry_budget.try_retry():
+                    _count_read_bytes(response.raw)
+                    return response
+                reason = f"HTTP {response.status_code}"
+                delay = max(self._backoff_delay(attempt), _retry_after(response))
+                response.close()
+            attempt += 1
+            metrics.incr('http_retries')
+            self._logger.info(f"{request.method} {request.url} failed ({reason}), "
+                              f"retry {attempt} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def create_session(pool_maxsize, timeout, headers=None):
+    """
+    Return a requests session using a TransportAdapter for http and https.
+
+    pool_maxsize should cover the number of requests made concurrently
+    against one host. Retries and rate limits are configured with the
+    HTTP_* environment variables.
+    """
+    adapter = TransportAdapter(
+        pool_maxsize=pool_maxsize,
+        timeout=timeout,
+        max_retries=int(os.environ.get("HTTP_MAX_RETRIES", 3)),
+        backoff=float(os.environ.get("HTTP_BACKOFF", 0.5)),
+        retry_budget=RetryBudget(float(os.environ.get("HTTP_RETRY_BUDGET", 0.2))),
+        rate_per_host=float(os.environ.get("HTTP_RATE_PER_HOST", 10)),
+        burst_per_host=float(os.environ.get("HTTP_BURST_PER_HOST", 20)),
+    )
+    session = requests.session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
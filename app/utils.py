@@ -1,20 +1,87 @@
+import functools
+import hashlib
+import json
 import logging
 import os
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-import markdown2
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_openai import ChatOpenAI
+# markdown2, langchain and PyMuPDF take most of the startup time, they are
+# imported inside the functions below
+from llm_cache import LLMCache
+from mail import MailTransport, iter_message_lines
+from metrics import metrics
+from storage import atomic_write
 
-import fitz  # PyMuPDF
+MODEL_NAME = os.environ.get("OPENAI_MODEL", "gpt-4o")
 
-PROMPT_TEMPLATE = """
+llm_cache = LLMCache(Path(os.environ.get("LLM_CACHE_DIR", ".llm_cache")),
+                     max_bytes=int(os.environ.get("LLM_CACHE_MAX_MB", 50)) * 1024 * 1024,
+                     max_age_days=float(os.environ.get("LLM_CACHE_MAX_AGE_DAYS", 90)))
+
+
+
+class RateLimiter:
+    """
+    Sliding one-minute window limiter for requests and tokens per minute.
+
+    acquire() blocks until sending a request of the given token count
+    keeps both limits within budget.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self._rpm = requests_per_minute
+        self._tpm = tokens_per_minute
+        self._window = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        # A single request larger than the budget is still let through alone
+        tokens = min(tokens, self._tpm)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._window and now - self._window[0][0] >= 60:
+                    self._window.popleft()
+                used_tokens = sum(t for _, t in self._window)
+                if len(self._window) < self._rpm and used_tokens + tokens <= self._tpm:
+                    self._window.append((now, tokens))
+                    return
+                wait = 60 - (now - self._window[0][0])
+            logging.info(f"LLM rate limit reached, wait for {wait:.1f} seconds ...")
+            time.sleep(wait)
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens of text without a tokenizer.
+
+    ASCII text takes roughly four characters per token. Japanese, Chinese
+    and other non-ASCII characters take about one token each, so they are
+    counted one by one instead of being undercounted fourfold.
+    """
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def _fitting_prefix(line, max_tokens):
+    """Return the length of the longest prefix of line within max_tokens estimated tokens."""
+    budget = (max_tokens - 1) * 4
+    for i, char in enumerate(line):
+        budget -= 1 if char.isascii() else 4
+        if budget < 0:
+            return max(i, 1)
+    return len(line)
+
+
+rate_limiter = RateLimiter(int(os.environ.get("LLM_REQUESTS_PER_MINUTE", 500)),
+                           int(os.environ.get("LLM_TOKENS_PER_MINUTE", 30000)))
+
+# The instructions and update shared by the summary and multilingual prompts
+SUMMARY_PROMPT_BODY = """
     Summarize the update from my daughter's homeroom teacher.
 
     List all the action items and information for the parents, grouping them into 'Action Items' and 'Information'.
@@ -49,14 +116,21 @@ PROMPT_TEMPLATE = """
     {text}
     ```
 
-    Summary in markdown format, no triple backticks:
 """
 
+PROMPT_TEMPLATE = SUMMARY_PROMPT_BODY + """    Summary in markdown format, no triple backticks:
+"""
+
+# Fixed translations of the summary headings, shared by the translation
+# and multilingual prompts
+TRANSLATION_GLOSSARY = (
+    '    For English to Japanese, translate "AI Summary" to "AI 概要", "Action Items" to "アクションアイテム", "Information" to "情報", "fact families" to "ファクトファミリー"\n'
+    '    For English to Chinese, translate "AI Summary" to "AI 总结", "Action Items" to "行动项目", "Information" to "信息", "fact families" to "fact families".\n'
+)
+
 TRANSLATION_PROMPT_TEMPLATE = """
     Translate the following content into {language}, keep the original markdown formatting.
-    For English to Japanese, translate "AI Summary" to "AI 概要", "Action Items" to "アクションアイテム", "Information" to "情報", "fact families" to "ファクトファミリー"
-    For English to Chinese, translate "AI Summary" to "AI 总结", "Action Items" to "行动项目", "Information" to "信息", "fact families" to "fact families".
-    
+""" + TRANSLATION_GLOSSARY + """    
     ```
     {content}
     ```
@@ -64,19 +138,293 @@ TRANSLATION_PROMPT_TEMPLATE = """
     Translation in markdown format, no triple backticks:
 """
 
-def summarize(text):
-    prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+DIGEST_PROMPT_TEMPLATE = """
+    Summarize the {count} updates below from my daughter's homeroom teacher.
+
+    For each update, list all the action items and information for the parents, grouping them into 'Action Items' and 'Information'.
+
+    Output in the following markdown formatting:
+
+    - The document starts with a title "AI Summary", formatted with a single '#'.
+    - Each update gets its own section marked with '##', titled with the date and author of the update, in the order given.
+    - Within each update, the content is divided into "Action Items" and "Information", each marked with '###'. Leave out a part that has no items.
+    - Under each part, list the items as numbered bullet points (1., 2., etc.). Each item should have a bolded item name followed by a colon.
+    - For each item, include any specific details or actions as sub-points, using unnumbered bullet points starting with a hyphen (-). **Do not number the sub-points.**
+
+    Updates from Homeroom Teacher:
+
+    {text}
+
+    Summary in markdown format, no triple backticks:
+"""
+
+# The summary prompt with the translations asked for in the same reply
+MULTILINGUAL_PROMPT_TEMPLATE = SUMMARY_PROMPT_BODY + """    Then translate the summary into each of these languages, keeping its markdown formatting: {languages}.
+""" + TRANSLATION_GLOSSARY + """
+    Reply with a JSON object that has the summary under "English" and each translation under the name of its language. Every value is markdown, no triple backticks.
+"""
+
+CHUNK_PROMPT_TEMPLATE = """
+    Below is part {part} of {parts} of a long update from my daughter's homeroom teacher, including its attachments.
+
+    Write concise notes of every action item and piece of information for the parents in this part.
+    Keep all dates, times, deadlines, names and things to bring. Leave out anything that is not relevant to parents.
+
+    ```
+    {text}
+    ```
+
+    Notes as a markdown bullet list, no triple backticks:
+"""
+
+# Ends every page of extracted PDF text, after its last newline
+PAGE_BREAK = '\f'
+
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", 6000))
+SUMMARY_CHUNK_TOKENS = int(os.environ.get("SUMMARY_CHUNK_TOKENS", 3000))
+SUMMARY_MAP_WORKERS = int(os.environ.get("SUMMARY_MAP_WORKERS", 4))
+# 'combined' summarizes and translates a post in one call, 'separate' makes
+# one call for the summary and one per translation
+SUMMARY_MODE = os.environ.get("SUMMARY_MODE", "separate")
+
+_chat_model = None
+
+
+def set_chat_model(model):
+    """Use model instead of ChatOpenAI, e.g. a stub model in benchmarks."""
+    global _chat_model
+    _chat_model = model
+    _get_chain.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_chain(template, json_fields=()):
+    # Chains are stateless, so build each one once per process
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_openai import ChatOpenAI
+
+    prompt = ChatPromptTemplate.from_template(template)
     output_parser = StrOutputParser()
-    model = ChatOpenAI(model="gpt-4o")
+    model = _chat_model or ChatOpenAI(model=MODEL_NAME)
+    if json_fields and _chat_model is None:
+        # Structured output: the reply is a JSON object with a string per field
+        model = model.bind(response_format={
+            'type': 'json_schema',
+            'json_schema': {
+                'name': 'sections',
+                'strict': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {field: {'type': 'string'} for field in json_fields},
+                    'required': list(json_fields),
+                    'additionalProperties': False,
+                },
+            },
+        })
     chain = (
         prompt
         | model
         | output_parser
     )
+    return chain
 
-    response = chain.invoke({'text': text})
+def _invoke(template, inputs, json_fields=(), validate=None):
+    key = LLMCache.key(template, MODEL_NAME, inputs)
+    response = llm_cache.get(key)
+    if response is not None:
+        logging.info("LLM cache hit, skip model call")
+        return response
+
+    prompt_tokens = estimate_tokens(template.format(**inputs))
+    with metrics.span('llm_rate_limit'):
+        rate_limiter.acquire(prompt_tokens)
+    with metrics.span('llm_call'):
+        response = _get_chain(template, json_fields).invoke(inputs)
+    metrics.incr('llm_calls')
+    metrics.incr('llm_prompt_tokens', prompt_tokens)
+    metrics.incr('llm_completion_tokens', estimate_tokens(response))
+    # A response that does not validate is not cached, so it is asked again
+    if validate is not None:
+        validate(response)
+    llm_cache.put(key, response)
     return response
 
+def remove_repeated_lines(texts, min_length=20):
+    """
+    Drop lines that were already seen on an earlier page or in an earlier text.
+
+    Letterheads, footers and disclaimers are repeated on every page and in
+    every attachment of a post. Pages are separated by PAGE_BREAK. A line
+    is only compared against earlier pages and texts, so content repeated
+    within a page, such as the same item under several days, is kept. Only
+    lines of at least min_length characters are compared, so short lines
+    such as list numbers are kept.
+
+    Parameters:
+    - texts: Texts to clean, in order.
+    - min_length: Minimum stripped length of a line to be deduplicated.
+
+    Returns:
+    - List of the cleaned texts, without page breaks.
+    """
+    seen = set()
+    cleaned = []
+    for text in texts:
+        pages = []
+        for page in text.split(PAGE_BREAK):
+            lines = []
+            page_keys = set()
+            for line in page.splitlines():
+                key = ' '.join(line.split()).lower()
+                if len(key) >= min_length:
+                    if key in seen:
+                        continue
+                    page_keys.add(key)
+                lines.append(line)
+            seen |= page_keys
+            pages.append('\n'.join(lines))
+        cleaned.append('\n'.join(pages))
+    return cleaned
+
+
+def split_into_chunks(text, max_tokens):
+    """
+    Split text into chunks of at most max_tokens estimated tokens.
+
+    Chunks end on paragraph or line boundaries where possible, a single
+    line longer than a chunk is cut at a whitespace or the end of a
+    Japanese sentence.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in text.splitlines(keepends=True):
+        while estimate_tokens(line) > max_tokens:
+            limit = _fitting_prefix(line, max_tokens)
+            cut = max(line.rfind(' ', 0, limit), line.rfind('。', 0, limit) + 1)
+            cut = cut if cut > 0 else limit
+            line_part, line = line[:cut], line[cut:]
+            if current:
+                chunks.append(''.join(current))
+                current, current_tokens = [], 0
+            chunks.append(line_part)
+        line_tokens = estimate_tokens(line)
+        if current_tokens + line_tokens > max_tokens:
+            chunks.append(''.join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        chunks.append(''.join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def _map_chunks(text):
+    chunks = split_into_chunks(text, SUMMARY_CHUNK_TOKENS)
+    logging.info(f"Summarizing {len(chunks)} chunks of a long update ...")
+    with metrics.span('summarize_map'), \
+            ThreadPoolExecutor(max_workers=SUMMARY_MAP_WORKERS) as executor:
+        return list(executor.map(
+            lambda item: _invoke(CHUNK_PROMPT_TEMPLATE,
+                                 {'part': item[0], 'parts': len(chunks), 'text': item[1]}),
+            enumerate(chunks, start=1)))
+
+
+def _condense(text):
+    """
+    Return text, or notes of it if it is longer than SUMMARY_MAX_TOKENS.
+
+    Long text is split into chunks that are summarized concurrently into
+    notes. Notes that are still too long go through another round of
+    chunking as long as that makes them shorter.
+    """
+    if estimate_tokens(text) <= SUMMARY_MAX_TOKENS:
+        return text
+
+    metrics.incr('summaries_map_reduce')
+    notes = '\n\n'.join(_map_chunks(text))
+    while estimate_tokens(notes) > SUMMARY_MAX_TOKENS:
+        shorter_notes = '\n\n'.join(_map_chunks(notes))
+        if len(shorter_notes) >= len(notes):
+            break
+        notes = shorter_notes
+    return notes
+
+
+def summarize(text):
+    """
+    Summarize an update into the "Action Items / Information" markdown.
+
+    Updates within SUMMARY_MAX_TOKENS are summarized in a single call.
+    Longer ones are first condensed into notes in chunks, and the notes
+    are then reduced to the final summary.
+    """
+    return _invoke(PROMPT_TEMPLATE, {'text': _condense(text)})
+
+
+def summarize_digest(texts):
+    """
+    Summarize several updates together, with a section per update.
+
+    A single update gets the same summary as from summarize(). Long updates
+    are condensed into notes on their own first, so every update keeps its
+    section.
+
+    Parameters:
+    - texts: Content of every update, oldest first.
+
+    Returns:
+    - Summary in Markdown format.
+    """
+    if len(texts) == 1:
+        return summarize(texts[0])
+    parts = [f"Update {i} of {len(texts)}:\n```\n{_condense(text)}\n```"
+             for i, text in enumerate(texts, start=1)]
+    return _invoke(DIGEST_PROMPT_TEMPLATE, {'count': len(texts), 'text': '\n\n'.join(parts)})
+
+
+def _parse_sections(response, fields):
+    # Models sometimes wrap JSON in a code fence despite the instructions
+    content = response.strip()
+    if content.startswith('```'):
+        content = content.split('\n', 1)[-1].rsplit('```', 1)[0]
+    sections = json.loads(content)
+    if not isinstance(sections, dict):
+        raise ValueError("Reply is not a JSON object")
+    missing = [field for field in fields
+               if not isinstance(sections.get(field), str) or not sections[field].strip()]
+    if missing:
+        raise ValueError(f"Reply has no {', '.join(missing)} section")
+    return [sections[field] for field in fields]
+
+
+def summarize_multilingual(text, languages):
+    """
+    Summarize an update and translate the summary in a single call.
+
+    The model replies with a JSON object with one markdown section for
+    English and one per language, so the update is sent once instead of
+    once for the summary and again for every translation. Long updates
+    are condensed into notes first, like in summarize().
+
+    Parameters:
+    - text: Content of the update.
+    - languages: Languages to translate the summary into.
+
+    Returns:
+    - List of the English summary followed by one translation per language.
+
+    Raises:
+    - ValueError if the reply is not a JSON object with every section.
+    """
+    fields = ('English',) + tuple(languages)
+    response = _invoke(MULTILINGUAL_PROMPT_TEMPLATE,
+                       {'text': _condense(text), 'languages': ', '.join(languages)},
+                       json_fields=fields,
+                       validate=lambda response: _parse_sections(response, fields))
+    return _parse_sections(response, fields)
+
 def translate(markdown_content, language):
     """
     Translate Markdown content to the specified language.
@@ -88,85 +436,112 @@ def translate(markdown_content, language):
     Returns:
     - Translated content in Markdown format.
     """
-    # Set up the translation client
-    prompt = ChatPromptTemplate.from_template(TRANSLATION_PROMPT_TEMPLATE)
-    output_parser = StrOutputParser()
-    model = ChatOpenAI(model="gpt-4o")
-    chain = (
-        prompt
-        | model
-        | output_parser
-    )
-
-    response = chain.invoke({'content': markdown_content, 'language': language})
-    return response
+    return _invoke(TRANSLATION_PROMPT_TEMPLATE,
+                   {'content': markdown_content, 'language': language})
 
 
 def markdown_to_html(markdown_content):
+    import markdown2
+
     html_content = markdown2.markdown(markdown_content)
-    logging.info(markdown_content)
-    logging.info(html_content)
+    logging.debug(f"Converted {len(markdown_content)} characters of markdown to html")
     return html_content
 
-def send_email(sender_email, receiver_email, bcc_emails, subject, html_content, attachment_file_paths):
+def send_email(sender_email, receiver_email, bcc_emails, subject, html_content, attachment_file_paths, transport=None,
+               inline_images=None):
     """
-    Send an email with Markdown content converted to HTML.
+    Send an HTML email with attachments.
 
     Parameters:
     - sender_email: Email address of the sender.
     - receiver_email: Email address of the receiver.
     - bcc_emails: List of BCC email addresses.
     - subject: Subject of the email.
-    - markdown_content: Content in Markdown format.
-    - app_password_env_var: Environment variable name where the app password is stored (default is 'GOOGLE_APP_PASSWORD').
+    - html_content: Body of the email in HTML.
+    - attachment_file_paths: Paths of the files to attach.
+    - transport: MailTransport to send with, a new connection is made for this email if omitted.
+    - inline_images: List of (content id, path) of images the html refers to as cid:<content id>.
 
     Returns:
     - None
+
+    Raises:
+    - EmailDeliveryError if the email could not be sent.
     """
-    # Read app password from environment variable
-    app_password = os.getenv('GOOGLE_APP_PASSWORD')
-    if not app_password:
-        raise ValueError("App password not found in environment variables.")
+    # Combine all recipient emails
+    all_recipients = [receiver_email] + bcc_emails
 
-    # Create the email message
-    msg = MIMEMultipart()
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
-    msg['Subject'] = subject
-    msg['Bcc'] = ", ".join(bcc_emails)
+    def build_lines():
+        return iter_message_lines(sender_email, receiver_email, subject,
+                                  html_content, attachment_file_paths,
+                                  inline_images)
 
-    # Attach the HTML content
-    msg.attach(MIMEText(html_content, 'html'))
+    with metrics.span('smtp_send'):
+        if transport is None:
+            with MailTransport() as transport:
+                transport.send(sender_email, all_recipients, build_lines)
+        else:
+            transport.send(sender_email, all_recipients, build_lines)
+    metrics.incr('emails_sent')
+    logging.info("Email sent successfully!")
 
-    # Combine all recipient emails
-    all_recipients = [receiver_email] + bcc_emails
 
-    for file_path in attachment_file_paths:
-        with open(file_path, "rb") as attachment:
-            # Instance of MIMEBase and named as part
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
-            # Encode file in ASCII characters to send by email    
-            encoders.encode_base64(part)
-            # Add header as key/value pair to attachment part
-            part.add_header('Content-Disposition', f'attachment; filename={os.path.basename(file_path)}')
-            # Attach the instance 'part' to instance 'msg'
-            msg.attach(part)
-
-    # Send email through Google's SMTP server
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender_email, app_password)
-            server.sendmail(sender_email, all_recipients, msg.as_string())
-        logging.info("Email sent successfully!")
-    except Exception as e:
-        logging.info(f"Failed to send email: {e}")
-
-
-def extract_text_from_pdf(pdf_path):
-    document = fitz.open(pdf_path)
-    all_text = ''
-    for page in document:
-        all_text += page.get_text() + '\n'  # Extracts text from each page
-    document.close()
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", 30))
+PDF_MAX_CHARS = int(os.environ.get("PDF_MAX_CHARS", 60000))
+PDF_TEXT_CACHE_DIR = Path(os.environ.get("PDF_TEXT_CACHE_DIR", ".pdf_text_cache"))
+
+
+def iter_pdf_text(pdf_path):
+    """Yield the text of a PDF one page at a time."""
+    import fitz  # PyMuPDF
+
+    with fitz.open(pdf_path) as document:
+        for page in document:
+            yield page.get_text()
+
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def extract_text_from_pdf(pdf_path, max_pages=None, max_chars=None):
+    """
+    Extract the text of a PDF within a page and character budget.
+
+    Pages are read one at a time and extraction stops as soon as either
+    budget is used up, so large scanned documents are never fully loaded.
+    Results are cached by file hash and budget.
+
+    Parameters:
+    - pdf_path: Path of the PDF file.
+    - max_pages: Maximum number of pages to read (default PDF_MAX_PAGES).
+    - max_chars: Maximum number of characters to return (default PDF_MAX_CHARS).
+
+    Returns:
+    - Extracted text.
+    """
+    max_pages = max_pages or PDF_MAX_PAGES
+    max_chars = max_chars or PDF_MAX_CHARS
+    cache_file = PDF_TEXT_CACHE_DIR / f"{_file_sha256(pdf_path)}-{max_pages}-{max_chars}.txt"
+    if cache_file.exists():
+        return cache_file.read_text()
+
+    parts = []
+    remaining = max_chars
+    for page_number, text in enumerate(iter_pdf_text(pdf_path)):
+        if page_number >= max_pages or remaining <= 0:
+            logging.info(f"Text budget reached for {pdf_path}, "
+                         f"stopped after {page_number} pages")
+            break
+        text = text[:remaining] + '\n' + PAGE_BREAK  # Extracts text from each page
+        remaining -= len(text)
+        parts.append(text)
+    all_text = ''.join(parts)
+
+    PDF_TEXT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    atomic_write(cache_file, all_text)
     return all_text
@@ -0,0 +1,48 @@
+import logging
+import os
+from datetime import datetime
+
+# Idle polls beyond this many no longer double the interval
+MAX_DOUBLINGS = 32
+
+
+class PollSchedule:
+    """
+    Adaptive polling interval for watch mode.
+
+    During school hours on school days the feed is polled every
+    school_interval seconds, otherwise every off_hours_interval seconds.
+    Each poll that finds nothing new doubles the interval, up to
+    max_interval, and a poll with new posts resets it.
+    """
+
+    def __init__(self, school_interval=None, off_hours_interval=None,
+                 max_interval=None, school_hours=None, school_days=None):
+        self._school_interval = float(school_interval or os.environ.get("WATCH_INTERVAL", 300))
+        self._off_hours_interval = float(off_hours_interval or os.environ.get("WATCH_OFF_HOURS_INTERVAL", 1800))
+        self._max_interval = float(max_interval or os.environ.get("WATCH_MAX_INTERVAL", 3600))
+        start, end = (school_hours or os.environ.get("WATCH_SCHOOL_HOURS", "7-17")).split('-')
+        self._school_hours = (int(start), int(end))
+        days = school_days or os.environ.get("WATCH_SCHOOL_DAYS", "0,1,2,3,4")
+        self._school_days = {int(day) for day in days.split(',')}
+        self._idle_polls = 0
+        self._logger = logging.getLogger(PollSchedule.__name__)
+
+    def _base_interval(self, now):
+        start, end = self._school_hours
+        if now.weekday() in self._school_days and start <= now.hour < end:
+            return self._school_interval
+        return self._off_hours_interval
+
+    def record(self, found_new_posts):
+        self._idle_polls = 0 if found_new_posts else self._idle_polls + 1
+
+    def next_interval(self, now=None):
+        base = self._base_interval(now or datetime.now())
+        # The interval reaches max_interval long before the cap, which only
+        # keeps the power from overflowing after weeks without posts
+        doublings = min(self._idle_polls, MAX_DOUBLINGS)
+        interval = min(base * 2 ** doublings, max(self._max_interval, base))
+        self._logger.info(f"Next poll in {interval:.0f} seconds "
+                          f"({self._idle_polls} polls without new posts)")
+        return interval
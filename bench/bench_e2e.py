@@ -0,0 +1,281 @@
+"""
+Time the whole pipeline offline against local stand-ins.
+
+A fake Schoology server serves a generated feed with show-more posts and
+PDF attachments, an SMTP sink receives the emails and a stub chat model
+answers summarize/translate after a fixed latency. Every feed size runs in
+its own subprocess so peak RSS is measured per size.
+
+Reported per size:
+- feed: fetch, parse, show-more, attachment download and PDF extraction
+- llm: summary and translations of every new post
+- smtp: sending one email per post
+- pipeline: process_updates() end to end in a fresh working directory
+- no-op: a second run in a fresh interpreter that finds nothing new,
+  including importing main, and which heavy libraries it loaded
+
+An -X importtime profile of importing main is printed at the end.
+
+SUMMARY_MODE=combined benchmarks the single-call multilingual summaries.
+
+Usage: python bench/bench_e2e.py [--sizes 10 100 1000] [--llm-latency 0.05]
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+APP_DIR = BENCH_DIR.parent / 'app'
+
+# Libraries a run without new posts should never import
+HEAVY_MODULES = ['selenium', 'bs4', 'langchain_core', 'langchain_openai', 'openai',
+                 'fitz', 'markdown2', 'PIL']
+
+STUB_SUMMARY = """# AI Summary
+## Action Items
+1. **Field Trip to the Zoo:**
+    - Pack lunch, a water bottle and a hat.
+
+## Information
+1. **No School:**
+    - Monday, October 14 is Sports Day.
+"""
+
+
+def stub_chat_model(latency):
+    from langchain_core.messages import AIMessage
+    from langchain_core.runnables import RunnableLambda
+
+    # Every reply is numbered, so translations of different summaries are
+    # not answered from the LLM cache
+    replies = itertools.count(1)
+
+    def reply(prompt_value):
+        time.sleep(latency)
+        summary = f"{STUB_SUMMARY}2. **Reply {next(replies)}**\n"
+        prompt = prompt_value.to_string()
+        if 'Reply with a JSON object' in prompt:
+            languages = re.search(r'into each of these languages, keeping its markdown '
+                                  r'formatting: (.*)\.', prompt).group(1).split(', ')
+            return AIMessage(content=json.dumps(
+                {field: summary for field in ['English'] + languages}))
+        return AIMessage(content=summary)
+
+    return RunnableLambda(reply)
+
+
+def peak_rss_mb():
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_kb / 1024, children_kb / 1024
+
+
+def run_single(posts, llm_latency, pdf_pages):
+    sys.path.insert(0, str(BENCH_DIR))
+    sys.path.insert(0, str(APP_DIR))
+    from fake_schoology import FakeSchoology, SmtpSink
+
+    schoology = FakeSchoology(posts, pdf_pages=pdf_pages)
+    sink = SmtpSink()
+    os.environ.update({
+        'SMTP_HOST': '127.0.0.1',
+        'SMTP_PORT': str(sink.port),
+        'SMTP_SSL': '0',
+        'SUMMARY_SENDER_EMAIL': 'sender@example.com',
+        'SUMMARY_RECEIVER_EMAIL': 'receiver@example.com',
+        'HOMEROOM_CLASS': 'Bench',
+        'LLM_REQUESTS_PER_MINUTE': str(10 ** 9),
+        'LLM_TOKENS_PER_MINUTE': str(10 ** 12),
+        'HTTP_RATE_PER_HOST': str(10 ** 6),
+        'HTTP_BURST_PER_HOST': str(10 ** 6),
+        # Relative, so every stage starts with an empty LLM cache in its
+        # fresh working directory
+        'LLM_CACHE_DIR': '.llm_cache',
+    })
+
+    import main
+    import utils
+    utils.set_chat_model(stub_chat_model(llm_latency))
+    languages = ["Japanese", "Chinese"]
+    llm_post_workers = int(os.environ.get("LLM_POST_WORKERS", 4))
+
+    def new_downloader():
+        os.chdir(tempfile.mkdtemp(prefix='gsu-bench-'))
+        downloader = main.SchoologyAlbumsDownloader(base_url=schoology.base_url)
+        downloader.state.set_meta('course_id', '1000000001')
+        return downloader
+
+    stages = {}
+
+    # Staged run: time every stage on its own
+    downloader = new_downloader()
+    courses = downloader.get_courses()
+    start = time.perf_counter()
+    new_posts = [post for _, posts in downloader.get_all_updates(courses)
+                 for post in reversed(posts)]
+    stages['feed'] = time.perf_counter() - start
+
+    def summarize_and_translate(post):
+        if utils.SUMMARY_MODE == 'combined':
+            return utils.summarize_multilingual(main.build_update_content(post), languages)
+        summary = utils.summarize(main.build_update_content(post))
+        return [summary] + main.translate_summary(summary, languages)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=llm_post_workers) as executor:
+        summaries = list(executor.map(summarize_and_translate, new_posts))
+    stages['llm'] = time.perf_counter() - start
+    llm_counters = main.metrics.snapshot()['counters']
+
+    start = time.perf_counter()
+    with main.MailTransport() as transport:
+        for post, summary in zip(new_posts, summaries):
+            attachment_file_paths = [attachment['full_path'] for attachment in post['attachments']
+                                     if attachment.get('text')]
+            html_content = post['html_content'] + ''.join(utils.markdown_to_html(s) for s in summary)
+            utils.send_email('sender@example.com', 'receiver@example.com', [],
+                             f"Bench {post['post_id']}", html_content,
+                             attachment_file_paths, transport=transport)
+    stages['smtp'] = time.perf_counter() - start
+    downloader.close()
+
+    # Pipeline run: what main() does, in a fresh working directory
+    downloader = new_downloader()
+    start = time.perf_counter()
+    with main.MailTransport() as transport:
+        main.process_updates(downloader, downloader.get_courses(), transport,
+                             languages, llm_post_workers)
+    stages['pipeline'] = time.perf_counter() - start
+    downloader.close()
+
+    # No-op run: same working directory, nothing new on the feed
+    process = subprocess.run(
+        [sys.executable, __file__, '--noop', os.getcwd(), '--base-url', schoology.base_url],
+        capture_output=True, text=True)
+    if process.returncode:
+        sys.stderr.write(process.stderr)
+        raise SystemExit("No-op run failed")
+    noop = json.loads(process.stdout.strip().splitlines()[-1])
+
+    rss_self, rss_children = peak_rss_mb()
+    result = {
+        'posts': posts,
+        'parsed_posts': len(new_posts),
+        'emails': sink.messages,
+        'http_mb': schoology.bytes_sent / (1024 * 1024),
+        'smtp_mb': sink.bytes_received / (1024 * 1024),
+        'stages': stages,
+        'llm_calls_per_post': llm_counters.get('llm_calls', 0) / max(len(new_posts), 1),
+        'llm_prompt_tokens_per_post':
+            llm_counters.get('llm_prompt_tokens', 0) / max(len(new_posts), 1),
+        'posts_per_second': posts / stages['pipeline'],
+        'peak_rss_mb': rss_self,
+        'peak_rss_children_mb': rss_children,
+        'metrics': main.metrics.snapshot(),
+        'noop': noop,
+    }
+    schoology.close()
+    sink.close()
+    return result
+
+
+def run_noop(workdir, base_url):
+    start = time.perf_counter()
+    os.chdir(workdir)
+    sys.path.insert(0, str(APP_DIR))
+    import main
+    imported = time.perf_counter()
+    downloader = main.SchoologyAlbumsDownloader(base_url=base_url)
+    with main.MailTransport() as transport:
+        processed = main.process_updates(downloader, downloader.get_courses(), transport,
+                                         ["Japanese", "Chinese"], 4)
+    downloader.close()
+    return {
+        'import_seconds': imported - start,
+        'seconds': time.perf_counter() - start,
+        'processed_posts': processed,
+        'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+def import_profile(top):
+    """Return the slowest imports of main as (cumulative seconds, module) from -X importtime."""
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                             cwd=APP_DIR, capture_output=True, text=True, check=True)
+    timings = []
+    for line in process.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (.*)', line)
+        if match:
+            timings.append((int(match.group(2)) / 1e6, match.group(3)))
+    return sorted(timings, reverse=True)[:top]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    arg_parser.add_argument('--llm-latency', type=float, default=0.05,
+                            help='seconds the stub chat model takes per call')
+    arg_parser.add_argument('--pdf-pages', type=int, default=3)
+    arg_parser.add_argument('--json', action='store_true', help='print results as json')
+    arg_parser.add_argument('--imports', type=int, default=15,
+                            help='number of slowest imports to list')
+    arg_parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    arg_parser.add_argument('--noop', help=argparse.SUPPRESS)
+    arg_parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.noop:
+        print(json.dumps(run_noop(args.noop, args.base_url)))
+        return
+    if args.single:
+        print(json.dumps(run_single(args.single, args.llm_latency, args.pdf_pages)))
+        return
+
+    results = []
+    for size in args.sizes:
+        process = subprocess.run(
+            [sys.executable, __file__, '--single', str(size),
+             '--llm-latency', str(args.llm_latency), '--pdf-pages', str(args.pdf_pages)],
+            capture_output=True, text=True)
+        if process.returncode:
+            sys.stderr.write(process.stderr)
+            raise SystemExit(f"Benchmark with {size} posts failed")
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    imports = import_profile(args.imports)
+    if args.json:
+        print(json.dumps({'results': results, 'imports': imports}, indent=2))
+        return
+
+    print(f"{'posts':>6} {'feed s':>8} {'llm s':>8} {'calls/post':>10} {'tokens/post':>11} {'smtp s':>8} {'pipeline s':>11} "
+          f"{'posts/s':>8} {'emails':>7} {'RSS MB':>7} {'child RSS MB':>13}")
+    for r in results:
+        stages = r['stages']
+        print(f"{r['posts']:>6} {stages['feed']:>8.2f} {stages['llm']:>8.2f} "
+              f"{r['llm_calls_per_post']:>10.1f} {r['llm_prompt_tokens_per_post']:>11.0f} "
+              f"{stages['smtp']:>8.2f} "
+              f"{stages['pipeline']:>11.2f} {r['posts_per_second']:>8.1f} {r['emails']:>7} "
+              f"{r['peak_rss_mb']:>7.0f} {r['peak_rss_children_mb']:>13.0f}")
+
+    print(f"\n{'posts':>6} {'no-op s':>8} {'import s':>9}  heavy modules loaded")
+    for r in results:
+        noop = r['noop']
+        print(f"{r['posts']:>6} {noop['seconds']:>8.2f} {noop['import_seconds']:>9.2f}  "
+              f"{', '.join(noop['heavy_modules']) or '-'}")
+
+    print(f"\nSlowest imports of main (-X importtime, cumulative)")
+    for seconds, module in imports:
+        print(f"{seconds:>8.3f}s {module}")
+
+
+if __name__ == '__main__':
+    main()
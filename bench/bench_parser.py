@@ -0,0 +1,110 @@
+"""
+Compare the feed parser backends on the recorded feed fixture.
+
+The fixture posts are repeated with fresh ids to build feeds of the
+requested sizes, then every backend parses each feed. Reports posts per
+second and the peak Python memory allocated while parsing (tracemalloc,
+so memory held by lxml's C tree is not counted). The backends must
+agree on every parsed field and on the html of show-more payloads.
+
+Usage: python bench/bench_parser.py [--sizes 10 100 1000] [--repeat 3]
+"""
+import argparse
+import json
+import re
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / 'app'))
+
+from feed_parser import BACKENDS, get_feed_parser  # noqa: E402
+from feed_fixtures import build_feed, show_more_payload  # noqa: E402
+
+# Show-more payloads beyond the fixture, with escaped text before and
+# after the first element
+FRAGMENTS = [
+    'Tom &amp; Jerry &lt;b&gt; said<p>See you &lt;soon&gt;</p>',
+    '<p>One</p> &amp; two &lt;i&gt;',
+    'Plain text only',
+]
+
+
+def run(backend, html, repeat):
+    parser = get_feed_parser(backend)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        posts = list(parser.iter_posts(html))
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    list(parser.iter_posts(html))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return posts, best, peak
+
+
+def normalized_html(html):
+    """Serialize html with sorted attributes, which the backends order differently."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup.find_all(True):
+        tag.attrs = dict(sorted(tag.attrs.items()))
+    return str(soup)
+
+
+def check_fragments():
+    fragments = [json.loads(show_more_payload())['update']] + FRAGMENTS
+    for fragment in fragments:
+        results = {}
+        for backend in BACKENDS:
+            raw_html, text, images = get_feed_parser(backend).parse_fragment(fragment)
+            results[backend] = (normalized_html(raw_html), re.sub(r'\s+', ' ', text), images)
+        if len(set(map(repr, results.values()))) > 1:
+            raise SystemExit(f"Backends disagree on the show-more payload {fragment[:60]!r}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--json', action='store_true', help='print results as json')
+    args = arg_parser.parse_args()
+
+    check_fragments()
+    results = []
+    for size in args.sizes:
+        html = build_feed(size)
+        reference = None
+        for backend in BACKENDS:
+            posts, seconds, peak = run(backend, html, args.repeat)
+            # Raw html may be serialized differently, every other field must agree
+            fields = [{k: v for k, v in post.items() if not k.endswith('html_content')}
+                      for post in posts]
+            if reference is None:
+                reference = fields
+            elif fields != reference:
+                raise SystemExit(f"{backend} disagrees with {list(BACKENDS)[0]} at {size} posts")
+            results.append({
+                'backend': backend,
+                'posts': size,
+                'seconds': seconds,
+                'posts_per_second': size / seconds,
+                'peak_mb': peak / (1024 * 1024),
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'backend':<12} {'posts':>6} {'posts/s':>10} {'peak MB':>8}")
+    for r in results:
+        print(f"{r['backend']:<12} {r['posts']:>6} {r['posts_per_second']:>10.0f} {r['peak_mb']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
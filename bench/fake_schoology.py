@@ -0,0 +1,171 @@
+"""
+Local stand-ins for Schoology and Gmail used by the benchmarks.
+
+FakeSchoology serves a generated course feed, show-more payloads, PDF
+attachments and images over HTTP. SmtpSink accepts and counts messages over plain
+SMTP. Both run in background threads on ephemeral ports.
+"""
+import http.server
+import io
+import json
+import re
+import socketserver
+import threading
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+from feed_fixtures import build_feed, post_marker, show_more_payload
+
+
+def make_pdf(pages):
+    document = fitz.open()
+    for number in range(pages):
+        page = document.new_page()
+        page.insert_text((72, 72), f"Worksheet page {number + 1}", fontsize=14)
+        page.insert_text((72, 100), "Practise fact families for 10 minutes every evening. " * 2,
+                         fontsize=8)
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+def make_jpeg(width, height):
+    image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+# Hosts of the images in the fixtures, served locally instead
+IMAGE_HOSTS = ['https://cs.schoology.com', 'https://asset-cdn.schoology.com']
+
+
+class FakeSchoology:
+
+    def __init__(self, posts, pdf_pages=3):
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        feed = build_feed(posts)
+        show_more = show_more_payload()
+        for host in IMAGE_HOSTS:
+            feed = feed.replace(host, self.base_url)
+            show_more = show_more.replace(host, self.base_url)
+        # Real feed responses are JSON wrapped html with escaped slashes
+        feed = json.dumps({'css': [], 'js': [], 'output': feed})
+        self.feed = feed.replace('/', '\\/').encode()
+        self.show_more = json.loads(show_more)
+        self.pdf = make_pdf(pdf_pages)
+        self.image = make_jpeg(2400, 1800)
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, body, content_type, headers=None):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+                    with fake._lock:
+                        fake.bytes_sent += len(body)
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                attachment = re.match(r'/attachment/(\d+)/', self.path)
+                if attachment:
+                    self._reply(fake.pdf, 'application/pdf', {
+                        'Content-Disposition': f'attachment; filename="{attachment.group(1)}.pdf"',
+                    })
+                elif self.path.startswith('/system/files/'):
+                    self._reply(fake.image, 'image/jpeg')
+                elif re.match(r'/course/\d+/feed', self.path):
+                    self._reply(fake.feed, 'application/json')
+                else:
+                    self._reply(b'<html><body>home</body></html>', 'text/html')
+
+            def do_POST(self):
+                # The full text of a post keeps its id like the feed does
+                post_id = re.match(r'/update/(\d+)/show_more', self.path).group(1)
+                show_more = dict(fake.show_more,
+                                 update=post_marker(post_id) + fake.show_more['update'])
+                self._reply(json.dumps(show_more).encode(), 'application/json')
+
+        return Handler
+
+
+class SmtpSink:
+    """Minimal SMTP server that accepts every message and only counts it."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def _reply(self, line):
+                self.wfile.write(line.encode() + b'\r\n')
+
+            def handle(self):
+                self._reply('220 smtp-sink ready')
+                in_data = False
+                size = 0
+                for line in self.rfile:
+                    if in_data:
+                        if line == b'.\r\n':
+                            in_data = False
+                            with sink._lock:
+                                sink.messages += 1
+                                sink.bytes_received += size
+                            self._reply('250 OK')
+                        else:
+                            size += len(line)
+                        continue
+                    command = line.strip().upper()
+                    if command.startswith(b'EHLO'):
+                        self._reply('250 smtp-sink')
+                    elif command == b'DATA':
+                        in_data = True
+                        size = 0
+                        self._reply('354 End data with <CR><LF>.<CR><LF>')
+                    elif command == b'QUIT':
+                        self._reply('221 Bye')
+                        return
+                    else:
+                        self._reply('250 OK')
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
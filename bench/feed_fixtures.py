@@ -0,0 +1,47 @@
+"""Build feeds of any size from the recorded fixture posts."""
+import re
+from pathlib import Path
+
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+
+FIRST_POST_ID = 8000000000
+FIRST_ATTACHMENT_ID = 9000000000
+
+
+def _fixture_parts():
+    html = (FIXTURES / 'feed.html').read_text()
+    posts = re.findall(r'<li class="[^"]*" id="edge-assoc-\d+".*?</li>\n', html, re.S)
+    head = html[:html.index(posts[0])]
+    tail = html[html.index(posts[-1]) + len(posts[-1]):]
+    return head, posts, tail
+
+
+def post_marker(post_id):
+    return f'<p>Bench post {post_id}</p>'
+
+
+def build_feed(size):
+    """
+    Return a feed html with size posts built from the fixture posts.
+
+    Every post and attachment gets a fresh id, so no two posts share an
+    attachment url. The post id is also added to the text of every post,
+    so no two posts are answered by the same cached LLM response.
+    """
+    head, posts, tail = _fixture_parts()
+    attachment_ids = iter(range(FIRST_ATTACHMENT_ID, FIRST_ATTACHMENT_ID + 100 * size))
+    body = []
+    for i in range(size):
+        post = posts[i % len(posts)]
+        post_id = FIRST_POST_ID + size - i
+        post = re.sub(r'edge-assoc-\d+', f'edge-assoc-{post_id}', post, count=1)
+        post = re.sub(r'/update/\d+/show_more', f'/update/{post_id}/show_more', post)
+        post = post.replace('<span class="update-body s-rte">',
+                            f'<span class="update-body s-rte">{post_marker(post_id)}', 1)
+        post = re.sub(r'/attachment/\d+/', lambda _: f'/attachment/{next(attachment_ids)}/', post)
+        body.append(post)
+    return head + ''.join(body) + tail
+
+
+def show_more_payload():
+    return (FIXTURES / 'show_more.json').read_text()